@@ -25,20 +25,46 @@ import tarfile
 import zipfile
 import itertools
 import shutil
+import threading
+import traceback
+import Queue
+import errno
+import multiprocessing
+import hashlib
+import cPickle
+import fcntl
+import time
+import re
+import stat
+import socket
+import collections
+import tempfile
+import atexit
 
 modules = ['Compiler', 'MPI', 'Boost', 'CUDA', 'Python']
 architectures = ['x86_64']
 
-packages = {}
-
-package_path = os.path.dirname(os.path.realpath(__file__))
-package_path = os.path.join(package_path, 'packages')
-
-def find_package(package):
-    for module in packages:
+class Registry(dict):
+    '''
+    All loaded packages by module and name. The name index is built once
+    after loading, so lookups don't scan every module.
+    '''
+    def __init__(self):
+        dict.__init__(self)
+        self.names = {}
+        self.complete = False
+
+    def index(self):
+        self.names = {}
+        for module in self:
+            for name in self[module]:
+                if not name in self.names:
+                    self.names[name] = (module, self[module][name])
+
+    def find(self, package):
         name = package.split('/', 2)
-        if name[0] in packages[module]:
-            found = packages[module][name[0]]
+        if name[0] in self.names:
+            (module, found) = self.names[name[0]]
             if len(name) == 2:
                 version = name[1]
             else:
@@ -46,30 +72,213 @@ def find_package(package):
             if found.has_version(version):
                 return (module, found, version)
 
-    return ('', Package(), '*')
+        return ('', Package(), '*')
 
-def download_source(url, destination):
+packages = Registry()
+
+package_path = os.path.dirname(os.path.realpath(__file__))
+package_path = os.path.join(package_path, 'packages')
+
+download_cache = os.path.join(package_path, 'source', 'downloads')
+registry_cache = os.path.join(package_path, 'source', 'registry.cache')
+
+# The Lmod spider caches, <basepath>/.buildit/lmod-cache if not set
+lmod_cache = None
+
+queue_poll_interval = 5
+# Workers refresh their heartbeat this often, claims of workers whose
+# heartbeat is older than the timeout are given to other workers
+queue_heartbeat_interval = 30
+queue_worker_timeout = 300
+
+def find_package(package):
+    return packages.find(package)
+
+def source_url(source):
+    if isinstance(source, dict):
+        return source['url']
+    return source
+
+def source_sha256(source):
+    if isinstance(source, dict) and 'sha256' in source:
+        return source['sha256'].lower()
+    return None
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+def state_path(basepath, *paths):
+    return os.path.join(basepath, '.buildit', *paths)
+
+class FileLock:
+    '''
+    An exclusive advisory lock on a file, held by at most one thread of one
+    process at a time. fcntl.lockf is used since it also works on NFS. A
+    lock which is not blocking raises an IOError with EAGAIN if it is held.
+    '''
+    thread_locks = {}
+    thread_locks_lock = threading.Lock()
+
+    def __init__(self, file_name, blocking = True):
+        self.file_name = file_name
+        self.blocking = blocking
+        self.fd = None
+        with FileLock.thread_locks_lock:
+            if not file_name in FileLock.thread_locks:
+                FileLock.thread_locks[file_name] = threading.Lock()
+            self.thread_lock = FileLock.thread_locks[file_name]
+
+    def __enter__(self):
+        if not self.thread_lock.acquire(self.blocking):
+            raise IOError(errno.EAGAIN, 'Locked by another thread', self.file_name)
+        try:
+            makedirs(os.path.dirname(self.file_name))
+            self.fd = os.open(self.file_name, os.O_RDWR | os.O_CREAT, 0o666)
+            fcntl.fcntl(self.fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            while True:
+                try:
+                    fcntl.lockf(self.fd, fcntl.LOCK_EX if self.blocking else
+                        fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError as e:
+                    # The kernel tracks locks per process, not per thread. It
+                    # reports a deadlock when another thread of this process
+                    # holds a lock the other process waits for, which resolves
+                    # once that thread is done.
+                    if e.errno == errno.EACCES:
+                        raise IOError(errno.EAGAIN, e.strerror, self.file_name)
+                    if e.errno != errno.EDEADLK:
+                        raise
+                    time.sleep(0.1)
+        except:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            self.thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+        self.thread_lock.release()
+
+def touch(file_name):
+    # Marks a cached file as used for the LRU eviction of --gc, the cache
+    # might not be writable for everyone using it
+    try:
+        os.utime(file_name, None)
+    except OSError:
+        pass
+
+def symlink_atomic(target, link_name):
+    tmp_name = '%s.tmp-%d-%d' % (link_name, os.getpid(), threading.current_thread().ident)
+    os.symlink(target, tmp_name)
+    os.rename(tmp_name, link_name)
+
+def write_file_atomic(file_name, content):
+    tmp_name = '%s.tmp-%d-%d' % (file_name, os.getpid(), threading.current_thread().ident)
+    f = open(tmp_name, 'w')
+    f.write(content)
+    f.close()
+    os.rename(tmp_name, file_name)
+
+def cached_source(source, cache):
+    url = source_url(source)
+    checksum = source_sha256(source)
+    url_index = os.path.join(cache, 'urls', hashlib.sha256(url).hexdigest())
+    if not checksum and os.path.exists(url_index):
+        checksum = open(url_index).read().strip()
+    if checksum:
+        cached = os.path.join(cache, 'sha256', checksum, url.split('/')[-1])
+        if os.path.exists(cached):
+            touch(cached)
+            return cached
+    return None
+
+def download_source(source, cache, progress = True):
+    '''
+    Downloads a source into the download cache and returns the path to the
+    archive. Completed downloads are stored by their sha256 checksum, partial
+    downloads are kept by URL and resumed with a HTTP Range request. Sources
+    given as {"url": ..., "sha256": ...} get verified against the checksum.
+    '''
+    cached = cached_source(source, cache)
+    if cached:
+        return cached
+
+    url = source_url(source)
+    expected = source_sha256(source)
     file_name = url.split('/')[-1]
-    file_name = os.path.join(destination, file_name)
+    url_key = hashlib.sha256(url).hexdigest()
+    url_index = os.path.join(cache, 'urls', url_key)
+
+    for path in ['urls', 'partial']:
+        makedirs(os.path.join(cache, path))
+
+    partial = os.path.join(cache, 'partial', url_key)
+    with FileLock(partial + '.lock'):
+        # Another process might have completed the download in the meantime
+        cached = cached_source(source, cache)
+        if cached:
+            return cached
+
+        digest = hashlib.sha256()
+        offset = 0
+        block_sz = 1024 * 1024
+        if os.path.exists(partial):
+            f = open(partial, 'rb')
+            while True:
+                buffer = f.read(block_sz)
+                if not buffer:
+                    break
+                digest.update(buffer)
+                offset += len(buffer)
+            f.close()
+
+        request = urllib2.Request(url)
+        if offset > 0:
+            request.add_header('Range', 'bytes=%d-' % offset)
+        try:
+            u = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code != 416:
+                raise
+            # The partial download is unusable, start all over again
+            offset = 0
+            u = urllib2.urlopen(urllib2.Request(url))
+        if offset > 0 and u.getcode() != 206:
+            offset = 0
+        if offset == 0:
+            digest = hashlib.sha256()
 
-    if not os.path.exists(file_name):
-        u = urllib2.urlopen(url)
         meta = u.info()
         try:
-            file_size = int(meta.getheaders('Content-Length')[0])
+            file_size = offset + int(meta.getheaders('Content-Length')[0])
         except:
             file_size = 0
-        print ('Downloading: %s Bytes: %s' % (url, file_size))
-        f = open(file_name, 'wb')
-        file_size_dl = 0
-        block_sz = 8192
+        if offset > 0:
+            print ('Resuming: %s at %s Bytes: %s' % (url, offset, file_size))
+        else:
+            print ('Downloading: %s Bytes: %s' % (url, file_size))
+
+        f = open(partial, 'ab' if offset > 0 else 'wb', 4 * block_sz)
+        file_size_dl = offset
         while True:
             buffer = u.read(block_sz)
             if not buffer:
                 break
 
             file_size_dl += len(buffer)
+            digest.update(buffer)
             f.write(buffer)
+            if not progress:
+                continue
             if file_size > 0.0:
                 status = '\r%10d [%3.2f%%]' % (file_size_dl, file_size_dl * 100. / file_size)
             else:
@@ -77,37 +286,702 @@ def download_source(url, destination):
             status = status + chr(8)*(len(status) + 1)
             print (status, end='')
         f.close()
-        print ('\rDownload complete: 100%')
 
-    return file_name
+        if file_size > 0 and file_size_dl != file_size:
+            raise Exception('Download of %s incomplete: got %s of %s Bytes' % (
+                url, file_size_dl, file_size))
+
+        checksum = digest.hexdigest()
+        if expected and checksum != expected:
+            os.remove(partial)
+            raise Exception('Checksum mismatch for %s: expected %s, got %s' % (
+                url, expected, checksum))
+
+        cached_dir = os.path.join(cache, 'sha256', checksum)
+        makedirs(cached_dir)
+        cached = os.path.join(cached_dir, file_name)
+        os.rename(partial, cached)
+        write_file_atomic(url_index, checksum + '\n')
+        if progress:
+            print ('\rDownload complete: 100%')
+        else:
+            print ('Download complete: %s' % (url))
+
+        return cached
+
+class Fetcher:
+    '''
+    Downloads sources in a bounded pool of threads. Every URL is fetched only
+    once, builds wait for the downloads they need so fetching the sources of
+    later builds overlaps with the first builds.
+    '''
+    def __init__(self, cache, jobs = 4):
+        self.cache = cache
+        self.jobs = max(1, jobs)
+        self.lock = threading.Lock()
+        self.downloads = {}
+        self.queue = Queue.Queue()
+        self.workers = []
+
+    def worker(self):
+        while True:
+            download = self.queue.get()
+            try:
+                download['file_name'] = download_source(download['source'],
+                    self.cache, False)
+            except Exception as e:
+                download['error'] = e
+                print('Downloading %s failed: %s' % (
+                    source_url(download['source']), e))
+            download['done'].set()
+
+    def fetch(self, sources):
+        with self.lock:
+            for source in sources:
+                url = source_url(source)
+                if url in self.downloads:
+                    continue
+                download = {'source': source, 'file_name': None,
+                    'error': None, 'done': threading.Event()}
+                self.downloads[url] = download
+                self.queue.put(download)
+
+            while len(self.workers) < min(self.jobs, len(self.downloads)):
+                thread = threading.Thread(target=self.worker)
+                thread.daemon = True
+                thread.start()
+                self.workers.append(thread)
+
+    def get(self, source):
+        self.fetch([source])
+        download = self.downloads[source_url(source)]
+        while not download['done'].wait(1):
+            pass
+        if download['error']:
+            raise download['error']
+        return download['file_name']
+
+    def wait(self):
+        failed = []
+        for url in sorted(self.downloads):
+            download = self.downloads[url]
+            while not download['done'].wait(1):
+                pass
+            if download['error']:
+                failed.append(url)
+        return failed
+
+decompressors = {
+    'bz2': [['pbzip2', '-dc'], ['lbzip2', '-dc']],
+    'gz': [['pigz', '-dc']],
+    'xz': [['xz', '-dc', '-T0']]
+}
+
+def find_program(name):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        program = os.path.join(path, name)
+        if os.path.isfile(program) and os.access(program, os.X_OK):
+            return program
+    return None
+
+def archive_compression(file_name):
+    f = open(file_name, 'rb')
+    magic = f.read(6)
+    f.close()
+    if magic.startswith('BZh'):
+        return 'bz2'
+    if magic.startswith('\x1f\x8b'):
+        return 'gz'
+    if magic.startswith('\xfd7zXZ\x00'):
+        return 'xz'
+    return None
+
+def open_tar_stream(file_name):
+    decompressor = None
+    compression = archive_compression(file_name)
+    for command in decompressors.get(compression, []):
+        if find_program(command[0]):
+            decompressor = subprocess.Popen(command + [file_name],
+                stdout=subprocess.PIPE)
+            return (tarfile.open(fileobj=decompressor.stdout, mode='r|'), decompressor)
+
+    if compression == 'xz':
+        raise Exception('xz is needed to extract %s' % (file_name))
+    return (tarfile.open(file_name, 'r|*'), None)
+
+def close_tar_stream(file_name, archive, decompressor):
+    archive.close()
+    if decompressor:
+        while decompressor.stdout.read(1024 * 1024):
+            pass
+        if decompressor.wait() != 0:
+            raise Exception('Decompressing %s failed' % (file_name))
 
 def extract_source(source_path, file_name):
-    archive = None
+    '''
+    Extracts an archive into source_path and returns the top level source
+    directory. Tar archives are extracted in a single streaming pass, using a
+    parallel decompressor if one is available. A marker next to the sources
+    records completed extractions so interrupted ones get redone.
+    '''
+    marker = os.path.join(source_path, '.%s.extracted' % (os.path.basename(file_name)))
+    with FileLock(os.path.join(source_path, '.%s.lock' % (os.path.basename(file_name)))):
+        return extract_archive(source_path, file_name, marker)
+
+def extract_archive(source_path, file_name, marker):
+    if os.path.exists(marker):
+        src_dir = open(marker).read().strip()
+        if os.path.exists(src_dir):
+            return src_dir
+
     if zipfile.is_zipfile(file_name):
         archive = zipfile.ZipFile(file_name, 'r')
         src_dir = os.path.dirname(archive.namelist()[0])
         if src_dir == '':
-            src_dir = os.path.splitext(file_name)[0]
-
-    elif tarfile.is_tarfile(file_name):
-        archive = tarfile.open(file_name, 'r')
-        src_info = archive.getmembers()[0]
-        if src_info.type != tarfile.DIRTYPE:
-            src_dir = os.path.splitext(os.path.splitext(file_name)[0])[0]
+            src_dir = os.path.splitext(os.path.basename(file_name))[0]
+        src_dir = os.path.join(source_path, src_dir)
+        if os.path.realpath(src_dir) == os.path.realpath(source_path):
+            raise Exception('Could not determine the source directory of %s' % (file_name))
+        if os.path.exists(src_dir):
+            shutil.rmtree(src_dir)
+        archive.extractall(source_path)
+        archive.close()
+    else:
+        (archive, decompressor) = open_tar_stream(file_name)
+
+        src_info = archive.next()
+        if src_info is None:
+            raise Exception('%s is empty' % (file_name))
+        # Archives of a directory's content, like tar czf x.tgz ., start with
+        # a ./ member and get a directory of their own like flat ones
+        components = [c for c in src_info.name.split('/') if c not in ['', '.']]
+        destination = source_path
+        if not components or (src_info.type != tarfile.DIRTYPE and len(components) == 1):
+            src_dir = os.path.splitext(os.path.splitext(os.path.basename(file_name))[0])[0]
+            destination = os.path.join(source_path, src_dir)
         else:
-            src_dir = src_info.name
+            src_dir = components[0]
+        src_dir = os.path.join(source_path, src_dir)
 
-    src_dir = os.path.join(source_path, src_dir)
+        if os.path.realpath(src_dir) == os.path.realpath(source_path):
+            raise Exception('Could not determine the source directory of %s' % (file_name))
+        if os.path.exists(src_dir):
+            shutil.rmtree(src_dir)
+        archive.extractall(destination)
+        close_tar_stream(file_name, archive, decompressor)
 
-    if not os.path.exists(src_dir):
-        archive.extractall(source_path)
-        print('Extracted %s to %s' % (file_name, src_dir))
+    write_file_atomic(marker, src_dir + '\n')
+    print('Extracted %s to %s' % (file_name, src_dir))
 
     return src_dir
 
+def relocate_prefix(path, relocations):
+    '''
+    Replaces the old prefixes with the new ones of the (old, new) pairs in
+    relocations in all files and symlinks below path. Text files are
+    rewritten, in binaries the prefixes are only replaced inside of NUL
+    terminated strings which are padded to keep their length. Returns False
+    if a binary would need a longer string than it has room for.
+    '''
+    relocations = dict((old, new) for (old, new) in relocations if old != new)
+    if not relocations:
+        return True
+
+    # Longer prefixes first, a prefix followed by more of a name is another one
+    olds = sorted(relocations, key=len, reverse=True)
+    prefix = re.compile('(%s)(?![\\w.+-])' % ('|'.join(re.escape(old) for old in olds)))
+    c_string = re.compile('(?:%s)[^\0]*\0' % ('|'.join(re.escape(old) for old in olds)))
+    replace = lambda content: prefix.sub(lambda match: relocations[match.group(1)], content)
+    def pad(match):
+        string = replace(match.group(0)[:-1])
+        if len(string) >= len(match.group(0)):
+            raise ValueError(match.group(0)[:-1])
+        return string + '\0' * (len(match.group(0)) - len(string))
+
+    for (root, dirs, files) in os.walk(path):
+        for name in dirs + files:
+            file_name = os.path.join(root, name)
+            if os.path.islink(file_name):
+                target = os.readlink(file_name)
+                if prefix.match(target):
+                    os.remove(file_name)
+                    os.symlink(replace(target), file_name)
+                continue
+            if not os.path.isfile(file_name):
+                continue
+
+            f = open(file_name, 'rb')
+            content = f.read()
+            f.close()
+            if not prefix.search(content):
+                continue
+            if not '\0' in content:
+                content = replace(content)
+            else:
+                try:
+                    content = c_string.sub(pad, content)
+                except ValueError as e:
+                    print('Can not relocate %s in %s, the new prefix is longer' % (
+                        e, file_name))
+                    return False
+
+            mode = os.stat(file_name).st_mode
+            os.chmod(file_name, mode | stat.S_IWUSR)
+            f = open(file_name, 'wb')
+            f.write(content)
+            f.close()
+            os.chmod(file_name, mode)
+
+    return True
+
+class ArtifactStore:
+    '''
+    Packed installation prefixes, keyed by the build hash of a node. The store
+    may live in a shared directory, so other build hosts or basepaths can
+    unpack a build instead of compiling it again.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def artifact(self, build_hash):
+        return os.path.join(self.path, build_hash[:2], '%s.tar.gz' % (build_hash))
+
+    def has(self, build_hash):
+        return os.path.exists(self.artifact(build_hash))
+
+    def pack(self, build_hash, node):
+        artifact = self.artifact(build_hash)
+        if os.path.exists(artifact):
+            return
+        makedirs(os.path.dirname(artifact))
+
+        metadata = {
+            'package': node.package.name(),
+            'version': node.version[0],
+            'arch': node.arch,
+            'prefix': node.prefix,
+            'basepath': node.basepath,
+            'created': time.time()
+        }
+        write_file_atomic(os.path.splitext(os.path.splitext(artifact)[0])[0] + '.json',
+            json.dumps(metadata, sort_keys=True) + '\n')
+
+        tmp_name = '%s.tmp-%d-%d' % (artifact, os.getpid(), threading.current_thread().ident)
+        archive = tarfile.open(tmp_name, 'w:gz', compresslevel=1)
+        archive.add(node.prefix, arcname='.')
+        archive.close()
+        os.rename(tmp_name, artifact)
+        print('Packed %s to %s' % (node, artifact))
+
+    def unpack(self, build_hash, prefix, basepath):
+        '''
+        Unpacks an artifact to prefix. Besides its own prefix, the prefixes of
+        its dependencies below the basepath it was built in are relocated to
+        basepath.
+        '''
+        artifact = self.artifact(build_hash)
+        touch(artifact)
+        metadata = json.load(open(os.path.splitext(os.path.splitext(artifact)[0])[0] + '.json'))
+        old_basepath = metadata.get('basepath')
+        relprefix = os.path.relpath(prefix, basepath)
+        if old_basepath is None and metadata['prefix'].endswith(os.sep + relprefix):
+            old_basepath = metadata['prefix'][:-len(os.sep + relprefix)]
+        if old_basepath is None:
+            print('Not using %s, the basepath it was built in is unknown' % (artifact))
+            return False
+
+        # Unpack next to the prefix and move it in place once it's complete
+        staging = '%s.staging-%d' % (prefix, os.getpid())
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        makedirs(staging)
+        (archive, decompressor) = open_tar_stream(artifact)
+        archive.extractall(staging)
+        close_tar_stream(artifact, archive, decompressor)
+
+        if not relocate_prefix(staging, [(metadata['prefix'], prefix),
+                (old_basepath, basepath)]):
+            shutil.rmtree(staging)
+            return False
+        if os.path.exists(prefix):
+            shutil.rmtree(prefix)
+        os.rename(staging, prefix)
+        return True
+
+class ContentStore:
+    '''
+    Files of installations stored by content in <basepath>/.buildit/store, to
+    share identical files between prefixes. Objects are named after the
+    sha256 and the permissions of a file and are shared as hardlinks, or as
+    reflinks (copy on write clones) on file systems supporting them.
+    Reflinked objects can't be told apart from unused ones, a store which was
+    ever used with reflinks is marked as such.
+    '''
+    FICLONE = 0x40049409
+
+    def __init__(self, basepath, mode = 'hardlink'):
+        self.path = state_path(basepath, 'store')
+        self.mode = mode
+        self.marked = False
+
+    def mark(self):
+        if self.mode == 'reflink' and not self.marked:
+            makedirs(self.path)
+            marker = os.path.join(self.path, 'reflink')
+            if not os.path.exists(marker):
+                open(marker, 'w').close()
+            self.marked = True
+
+    def object(self, file_name, file_stat):
+        digest = file_digest(file_name)
+        return os.path.join(self.path, digest[:2], '%s-%o' % (digest,
+            stat.S_IMODE(file_stat.st_mode)))
+
+    def clone(self, source, target):
+        tmp_name = '%s.tmp-%d-%d' % (target, os.getpid(), threading.current_thread().ident)
+        if self.mode == 'hardlink':
+            os.link(source, tmp_name)
+        else:
+            src = open(source, 'rb')
+            dst = open(tmp_name, 'wb')
+            try:
+                fcntl.ioctl(dst.fileno(), ContentStore.FICLONE, src.fileno())
+            except:
+                dst.close()
+                os.remove(tmp_name)
+                raise
+            finally:
+                src.close()
+            dst.close()
+            shutil.copystat(source, tmp_name)
+        os.rename(tmp_name, target)
+
+    def share(self, file_name, target = None):
+        '''
+        Puts the stored object with the content of file_name in place of
+        target, which defaults to file_name itself. Files not stored yet are
+        added to the store. Returns the number of bytes saved.
+        '''
+        target = target or file_name
+        self.mark()
+        file_stat = os.lstat(file_name)
+        obj = self.object(file_name, file_stat)
+        stored = True
+        try:
+            obj_stat = os.stat(obj)
+        except OSError:
+            stored = False
+            makedirs(os.path.dirname(obj))
+            if target == file_name:
+                self.clone(file_name, obj)
+                return 0
+            # Store a copy, the source tree might change later on
+            tmp_name = '%s.tmp-%d-%d' % (obj, os.getpid(), threading.current_thread().ident)
+            shutil.copy2(file_name, tmp_name)
+            os.rename(tmp_name, obj)
+            obj_stat = os.stat(obj)
+        if target == file_name and (obj_stat.st_dev, obj_stat.st_ino) == (
+                file_stat.st_dev, file_stat.st_ino):
+            return 0
+        self.clone(obj, target)
+        # Nothing is shared yet if the content was just stored
+        return file_stat.st_size if stored else 0
+
+    def deduplicate(self, prefix):
+        '''
+        Replaces the files below prefix which have the same content as files
+        of other installations. Returns the number of bytes saved.
+        '''
+        saved = 0
+        try:
+            for (root, dirs, files) in os.walk(prefix):
+                for name in files:
+                    file_name = os.path.join(root, name)
+                    file_stat = os.lstat(file_name)
+                    if stat.S_ISREG(file_stat.st_mode) and file_stat.st_size > 0:
+                        saved += self.share(file_name)
+        except (IOError, OSError) as e:
+            print('Could not deduplicate %s: %s' % (prefix, e))
+        return saved
+
+def install_tree(source, target, store = None):
+    '''
+    Copies the tree below source to target. With a store the files are shared
+    with other installations, otherwise they are plain copies. Returns the
+    number of bytes shared.
+    '''
+    saved = 0
+    for (root, dirs, files) in os.walk(source):
+        target_root = os.path.join(target, os.path.relpath(root, source))
+        makedirs(target_root)
+        for name in dirs + files:
+            file_name = os.path.join(root, name)
+            target_name = os.path.join(target_root, name)
+            if os.path.islink(file_name):
+                if os.path.lexists(target_name):
+                    os.remove(target_name)
+                os.symlink(os.readlink(file_name), target_name)
+            elif os.path.isfile(file_name):
+                if store:
+                    saved += store.share(file_name, target_name)
+                else:
+                    shutil.copy2(file_name, target_name)
+    return saved
+
+class InstallDB:
+    '''
+    The manifest of installed builds, one JSON record per line in
+    <basepath>/.buildit/installed.jsonl. Records are keyed by their prefix.
+    Updates re-read the manifest and rewrite it atomically while holding a
+    lock, so concurrent build.py processes don't lose each other's records.
+    '''
+    def __init__(self, basepath):
+        self.file_name = state_path(basepath, 'installed.jsonl')
+        self.lock = FileLock(self.file_name + '.lock')
+        self.records = {}
+        self.load()
+
+    def exists(self):
+        return os.path.exists(self.file_name)
+
+    def load(self):
+        records = {}
+        if os.path.exists(self.file_name):
+            for line in open(self.file_name):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    records[record['prefix']] = record
+                except (ValueError, KeyError):
+                    print('Ignoring invalid record in %s: %s' % (
+                        self.file_name, line.strip()))
+        self.records = records
+
+    def save(self):
+        makedirs(os.path.dirname(self.file_name))
+        content = ''
+        for prefix in sorted(self.records):
+            content += json.dumps(self.records[prefix], sort_keys=True) + '\n'
+        write_file_atomic(self.file_name, content)
+
+    def add(self, record):
+        with self.lock:
+            self.load()
+            self.records[record['prefix']] = record
+            self.save()
+
+    def remove(self, prefixes):
+        with self.lock:
+            self.load()
+            for prefix in prefixes:
+                if prefix in self.records:
+                    del self.records[prefix]
+            self.save()
+
+    def replace(self, records):
+        with self.lock:
+            self.records = dict((record['prefix'], record) for record in records)
+            self.save()
+
+    def __contains__(self, prefix):
+        return prefix in self.records
+
+    def get(self, prefix):
+        return self.records.get(prefix)
+
+    def find(self, name = None, version = None, arch = None):
+        records = []
+        for prefix in sorted(self.records):
+            record = self.records[prefix]
+            if name and record['package'] != name:
+                continue
+            if version and record['version'] != version:
+                continue
+            if arch and record['arch'] != arch:
+                continue
+            records.append(record)
+        return records
+
+install_dbs = {}
+
+def installed_db(basepath):
+    if not basepath in install_dbs:
+        db = InstallDB(basepath)
+        install_dbs[basepath] = db
+        if not db.exists():
+            reindex(basepath)
+    return install_dbs[basepath]
+
+def append_jsonl(file_name, entry):
+    with FileLock(file_name + '.lock'):
+        f = open(file_name, 'a')
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+        f.close()
+
+def append_history(basepath, entry):
+    append_jsonl(state_path(basepath, 'history.jsonl'), entry)
+
+def append_event(basepath, entry):
+    append_jsonl(state_path(basepath, 'events.jsonl'), entry)
+
+step_marker = '==> buildit step'
+step_marker_re = re.compile('^%s (\\d+) (started|finished) ([0-9.]+)(?: (\\d+))?$' % (step_marker))
+
+def step_phase(step):
+    if re.search(r'\b(make|ninja)\b.*\binstall\b|\bcmake\b.*--install', step):
+        return 'install'
+    if re.search(r'configure|bootstrap|\bcmake\b', step) and not '--build' in step:
+        return 'configure'
+    return 'build'
+
+def step_times(log_file):
+    '''
+    Returns (index, start, end, status) of the recipe steps from the markers
+    written to a build log.
+    '''
+    started = {}
+    steps = []
+    for line in open(log_file):
+        match = step_marker_re.match(line.strip())
+        if not match:
+            continue
+        (index, state, stamp, status) = match.groups()
+        if state == 'started':
+            started[int(index)] = float(stamp)
+        elif int(index) in started:
+            steps.append((int(index), started[int(index)], float(stamp), int(status)))
+    return steps
+
+def log_tail(log_file, lines):
+    f = open(log_file)
+    tail = collections.deque(f, lines)
+    f.close()
+    return ''.join(tail)
+
+def load_history(basepath):
+    history = state_path(basepath, 'history.jsonl')
+    entries = []
+    if os.path.exists(history):
+        for line in open(history):
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                pass
+    return entries
+
+class BuildEstimates:
+    '''
+    Estimates build durations from the history of past builds. The last build
+    of the same prefix is used if there is one, otherwise the average of the
+    builds of the same package version, or of the package.
+    '''
+    def __init__(self, history):
+        self.prefixes = {}
+        self.versions = {}
+        self.packages = {}
+        for entry in history:
+            if entry.get('origin') != 'build':
+                continue
+            duration = entry['build_time']
+            self.prefixes[entry['prefix']] = duration
+            self.versions.setdefault((entry['package'], entry['version']), []).append(duration)
+            self.packages.setdefault(entry['package'], []).append(duration)
+
+    def estimate(self, node):
+        if node.prefix in self.prefixes:
+            return self.prefixes[node.prefix]
+        for (index, key) in [(self.versions, (node.package.name(), node.version[0])),
+                (self.packages, node.package.name())]:
+            if key in index:
+                return sum(index[key]) / len(index[key])
+        return None
+
+def format_duration(seconds):
+    if seconds is None:
+        return '?'
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+def format_size(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            break
+        size /= 1024.
+    else:
+        unit = 'TiB'
+    return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+
+def parse_size(size):
+    match = re.match(r'^\s*([0-9.]+)\s*([kmgt]?)(i?b)?\s*$', size, re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError('invalid size: %s' % (size))
+    return int(float(match.group(1)) * 1024 ** ' kmgt'.index(match.group(2).lower() or ' '))
+
+def run_parallel(function, items, jobs = 8):
+    '''
+    Calls function for all items in a pool of threads and returns the
+    results in the order of the items.
+    '''
+    tasks = Queue.Queue()
+    for (index, item) in enumerate(items):
+        tasks.put((index, item))
+    results = [None] * len(items)
+
+    def worker():
+        while True:
+            try:
+                (index, item) = tasks.get(False)
+            except Queue.Empty:
+                return
+            try:
+                results[index] = function(item)
+            except Exception:
+                traceback.print_exc()
+
+    workers = []
+    for i in range(min(max(1, jobs), max(1, len(items)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+    for thread in workers:
+        thread.join()
+    return results
+
+def disk_usage(path):
+    '''
+    Returns the bytes allocated by the files below path, hardlinked files are
+    only counted once.
+    '''
+    usage = 0
+    seen = set()
+    for (root, dirs, files) in os.walk(path):
+        for name in dirs + files:
+            try:
+                file_stat = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if file_stat.st_nlink > 1:
+                if (file_stat.st_dev, file_stat.st_ino) in seen:
+                    continue
+                seen.add((file_stat.st_dev, file_stat.st_ino))
+            usage += file_stat.st_blocks * 512
+    return usage
+
+def format_deps(deps):
+    if not deps:
+        return 'Core'
+    return ', '.join('%s/%s' % tuple(deps[name]) for name in sorted(deps))
+
 class Package:
     def __init__(self, json_data = {}):
         self.json_data = json_data
+        self.version_entries = {}
+        self.version_names = ()
+        if 'versions' in json_data:
+            self.version_names = tuple(v[0] for v in json_data['versions'])
+            self.version_entries = dict((v[0], v) for v in json_data['versions'])
 
     def __str__(self):
         if 'name' in self.json_data:
@@ -133,19 +1007,10 @@ class Package:
         return self.architecture() == arch;
 
     def has_version(self, version):
-        if version == '*':
-            return True
-        for v in self.json_data['versions']:
-            if v[0] == version:
-                return True;
+        return version == '*' or version in self.version_entries
 
     def versions(self):
-        versions = []
-        if 'versions' in self.json_data:
-            for version in self.json_data['versions']:
-                versions.extend([version[0]])
-
-        return versions
+        return list(self.version_names)
 
     def module_env_vars(self):
         if 'modulefile' in self.json_data:
@@ -161,6 +1026,18 @@ class Package:
                 return modulefile['paths']
         return {}
 
+    def module_paths(self):
+        paths = {
+            'PATH' : ['bin'],
+            'LD_LIBRARY_PATH': ['lib', 'lib64'],
+            'MANPATH': ['share/man'],
+            'INFOPATH': ['share/info'],
+            'PKG_CONFIG_PATH': ['lib/pkgconfig'],
+            'PYTHONPATH': ['share/%s/python' % (self.name())]
+        }
+        paths.update(self.module_path_vars())
+        return paths
+
     def get_data(self, name):
         if name in self.json_data:
             return self.json_data[name]
@@ -251,7 +1128,7 @@ class Package:
 
         return os.path.join(path, self.name(), version)
 
-    def build_dir(self, basepath, arch, version, deps=None):
+    def build_dir(self, basepath, arch, version, deps=None, create=True):
         path = os.path.join(basepath, "build", arch)
         if deps:
             if 'compiler' in deps:
@@ -270,8 +1147,8 @@ class Package:
                 path = os.path.join(path,
                     deps['boost'][0].name() + '-' + deps['boost'][1][0])
 
-        if not os.path.exists(path):
-            os.makedirs(path)
+        if create:
+            makedirs(path)
 
         return path
 
@@ -297,7 +1174,18 @@ class Package:
 
         return deps_dir
 
-    def base_modulefile(self, basepath, arch, rext_deps, deps):
+    def module_tree(self, basepath, arch, rext_deps):
+        '''
+        Returns the start of the directory the modulefiles of packages built
+        with this one go to, it is completed by the version of this package.
+        '''
+        deps_dir = self.get_deps_path(rext_deps)
+        if deps_dir:
+            deps_dir += '-'
+        return os.path.join(basepath, arch, 'modulefiles',
+            '%s%s-' % (deps_dir, self.name()))
+
+    def base_modulefile(self, basepath, arch, rext_deps, deps, force = False):
         modulefiles = os.path.join(basepath, arch, 'modulefiles')
 
         deps_dir = self.get_deps_path(rext_deps)
@@ -312,14 +1200,13 @@ class Package:
             base_module_dir = os.path.join(modulefiles, '.base', self.name())
         base_module = os.path.join(base_module_dir, 'generic.lua')
 
-        if os.path.exists(base_module):
+        if os.path.exists(base_module) and not force:
             if deps_dir == '':
                 return (base_module, os.path.join(modulefiles, 'Core', self.name()))
             else:
                 return (base_module, os.path.join(modulefiles, self.name()))
 
-        if not os.path.exists(base_module_dir):
-            os.makedirs(base_module_dir)
+        makedirs(base_module_dir)
 
         base_content =  'local pkgNameVer  = myModuleFullName()\n'
         base_content += 'local pkgName     = myModuleName()\n'
@@ -327,8 +1214,9 @@ class Package:
 
 
         base_var = 'local base = pathJoin("%s"' % (prefix_base)
-        mpath_var = 'local mpath = "%s-%s-"..fullVersion\n' % (modulefiles, self.name())
+        mpath_var = 'local mpath = "%s"..fullVersion\n' % (self.module_tree(basepath, arch, rext_deps))
         base_content += base_var + ', fullVersion)\n'
+        base_content += mpath_var
 
         for (module, package, version) in deps:
             base_content += 'load("%s/%s")\n' % (package.name(), version)
@@ -352,15 +1240,7 @@ class Package:
         if len(envs) > 0:
             base_content += '\n'
 
-        paths = {
-            'PATH' : ['bin'],
-            'LD_LIBRARY_PATH': ['lib', 'lib64'],
-            'MANPATH': ['share/man'],
-            'INFOPATH': ['share/info'],
-            'PKG_CONFIG_PATH': ['lib/pkgconfig'],
-            'PYTHONPATH': ['share/%s/python' % (self.name())]
-        }
-        paths.update(self.module_path_vars())
+        paths = self.module_paths()
         for path in paths:
             for p in paths[path]:
                 base_content += 'if (isDir(pathJoin(base, "%s"))) then\n' % (p)
@@ -376,81 +1256,163 @@ class Package:
         base_content += '   execute {cmd="source "..completionFile, modeA={"load"}}\n'
         base_content += 'end\n'
 
-        f = open(base_module, 'w')
-        f.write(base_content)
-        f.close()
+        write_file_atomic(base_module, base_content)
 
         if deps_dir == '':
             return (base_module, os.path.join(modulefiles, 'Core', self.name()))
         else:
             return (base_module, os.path.join(modulefiles, self.name()))
 
-    def write_modulefile(self, basepath, arch, version, rext_deps, deps):
-        (base_module, prefix_base) = self.base_modulefile(basepath, arch, rext_deps, deps)
-        if not os.path.exists(prefix_base):
-            os.makedirs(prefix_base)
-        prefix_base = os.path.join(prefix_base, '%s.lua' % (version))
-        if not os.path.exists(prefix_base):
-            os.symlink(base_module, prefix_base)
+    def module_environment(self, basepath, arch, prefix, version, rext_deps):
+        '''
+        Returns the changes loading the modulefile of an installation makes to
+        the environment, the same base_modulefile writes down for Lmod.
+        '''
+        name = self.name().upper().replace('-', '_')
+        changes = [['setenv', name + '_DIR', prefix],
+            ['setenv', name + '_ROOT', prefix]]
+        envs = self.module_env_vars()
+        for env in envs:
+            changes.append(['setenv', env, os.path.join(prefix, envs[env])])
+        paths = self.module_paths()
+        for path in paths:
+            for p in paths[path]:
+                if os.path.isdir(os.path.join(prefix, p)):
+                    changes.append(['prepend_path', path, os.path.join(prefix, p)])
+        # Modulefiles of packages built with this one might only show up later
+        changes.append(['prepend_dir', 'MODULEPATH',
+            self.module_tree(basepath, arch, rext_deps) + version])
+        return changes
+
+    def resolved_modulefile(self, basepath, arch, version, rext_deps, deps):
+        '''
+        Returns the modulefile of one installed version. Unlike the generic
+        one it doesn't look for the directories of the installation whenever
+        it is loaded, they were looked up once after installing.
+        '''
+        prefix = self.prefix(basepath, arch, version, rext_deps)
+
+        content =  'local base  = "%s"\n' % (prefix)
+        content += 'local mpath = "%s%s"\n' % (self.module_tree(basepath, arch, rext_deps), version)
+
+        for (module, package, dversion) in deps:
+            content += 'load("%s/%s")\n' % (package.name(), dversion)
+
+        content += '\n'
+        content += 'whatis("Name: %s")\n' % self.name()
+        content += 'whatis("Version: %s")\n' % version
+        content += 'whatis("Category: %s")\n' % self.get_data('category')
+        content += 'whatis("Description: %s")\n' % self.get_data('description')
+        content += 'whatis("URL: %s")\n' % self.get_data('url')
+        content += 'whatis("Keywords: %s")\n' % self.get_data('keywords')
+        content += '\n'
+
+        content += 'setenv("%s_DIR", base)\n' % self.name().upper().replace('-', '_')
+        content += 'setenv("%s_ROOT", base)\n' % self.name().upper().replace('-', '_')
+        content += '\n'
 
-    def is_installed(self, basepath, arch, version, deps=None):
-        return os.path.exists(self.prefix(basepath, arch, version, deps))
+        envs = self.module_env_vars()
+        for env in envs:
+            content += 'setenv("%s", pathJoin(base, "%s"))\n' % (env, envs[env])
+        if len(envs) > 0:
+            content += '\n'
 
-    def install_version(self, basepath, arch, module, version, env, ext_deps = None):
-        if type(version) is unicode or type(version) is str:
-            for v in self.json_data['versions']:
-                if v[0] == version:
-                    version = v
-                    break
+        paths = self.module_paths()
+        for path in paths:
+            for p in paths[path]:
+                if os.path.isdir(os.path.join(prefix, p)):
+                    content += 'prepend_path("%s", pathJoin(base, "%s"))\n' % (path, p)
+
+        content += '\n'
+        # Packages built with this one are only added later on
+        content += 'if (isDir(mpath)) then\n'
+        content += '   prepend_path("MODULEPATH", mpath)\n'
+        content += 'end\n'
+        completion_file = os.path.join(prefix, 'etc', 'bash_completion.d', self.name())
+        if os.path.isfile(completion_file):
+            content += 'execute {cmd="source %s", modeA={"load"}}\n' % (completion_file)
+        return content
+
+    def write_modulefile(self, basepath, arch, version, rext_deps, deps,
+            style = 'resolved', force = False):
+        modulefile = self.modulefile(basepath, arch, version, rext_deps)
+        if style == 'resolved':
+            makedirs(os.path.dirname(modulefile))
+            write_file_atomic(modulefile, self.resolved_modulefile(basepath, arch,
+                version, rext_deps, deps))
+            return modulefile
+
+        (base_module, prefix_base) = self.base_modulefile(basepath, arch, rext_deps,
+            deps, force)
+        makedirs(prefix_base)
+        if force or not os.path.islink(modulefile):
+            symlink_atomic(base_module, modulefile)
+        return modulefile
+
+    def modulefile(self, basepath, arch, version, rext_deps):
+        deps_dir = self.get_deps_path(rext_deps)
+        if deps_dir == '':
+            deps_dir = 'Core'
+        return os.path.join(basepath, arch, 'modulefiles', deps_dir,
+            self.name(), '%s.lua' % (version))
 
-        module_path = os.path.join(package_path, module)
-        source_path = os.path.join(package_path, 'source', self.name(), version[0])
-        if not os.path.exists(source_path):
-            os.makedirs(source_path)
+    def recipe_hash(self):
+        recipe = json.dumps(self.get_data('build'), sort_keys=True)
+        return hashlib.sha256(recipe).hexdigest()
 
-        build_env = env.copy()
-        build_env['PACKAGE_VERSION'] = str(version[0])
+    def is_installed(self, basepath, arch, version, deps=None):
+        return self.prefix(basepath, arch, version, deps) in installed_db(basepath)
 
-        rext_deps = {}
+    def version_entry(self, version):
+        if type(version) is unicode or type(version) is str:
+            return self.version_entries.get(version, version)
+        return version
+
+    def expand_version(self, graph, basepath, arch, module, version, ext_deps = None):
+        version = self.version_entry(version)
 
-        compiler = (None, ['*'])
-        mpi = (None, ['*'])
-        boost = (None, ['*'])
-        cuda = (None, ['*'])
-        python = (None, ['*'])
+        nodes = []
 
         for deps in self.build_deps:
             build_deps = []
+            rext_deps = {}
+
+            compiler = (None, ['*'])
+            mpi = (None, ['*'])
+            boost = (None, ['*'])
+            cuda = (None, ['*'])
+            python = (None, ['*'])
+
             def extract_package(package, pversion):
                 if pversion == '*': return (package, package.versions())
-                else: return [(package, [pversion])]
+                else: return (package, [pversion])
 
-            for (module, package, pversion) in deps:
-                if module == 'Compiler':
+            for (dmodule, package, pversion) in deps:
+                if dmodule == 'Compiler':
                     if ext_deps and 'compiler' in ext_deps:
                         compiler = ext_deps['compiler']
                     else:
                         compiler = extract_package(package, pversion)
                     rext_deps['compiler'] = compiler
-                elif module == 'MPI':
+                elif dmodule == 'MPI':
                     if ext_deps and  'mpi' in ext_deps:
                         mpi = ext_deps['mpi']
                     else:
                         mpi = extract_package(package, pversion)
                     rext_deps['mpi'] = mpi
-                elif module == 'Boost':
+                elif dmodule == 'Boost':
                     if ext_deps and  'boost' in ext_deps:
                         boost = ext_deps['boost']
                     else:
                         boost = extract_package(package, pversion)
                     rext_deps['boost'] = boost
-                elif module == 'CUDA':
+                elif dmodule == 'CUDA':
                     if ext_deps and  'cuda' in ext_deps:
                         cuda = ext_deps['cuda']
                     else:
                         cuda = extract_package(package, pversion)
                     rext_deps['cuda'] = cuda
-                elif module == 'Python':
+                elif dmodule == 'Python':
                     if ext_deps and  'python' in ext_deps:
                         python = ext_deps['python']
                     else:
@@ -459,188 +1421,295 @@ class Package:
                 else:
                     if pversion == '*':
                         raise Exception('Build script doesn\'t support wildcard versions for non Module packages')
-                    build_deps.extend([(module, package, pversion)])
-
+                    build_deps.extend([(dmodule, package, pversion)])
 
-            print('Installing Package %s/%s.' %(
-                self.name(), version[0]))
-
-            for boost_version in boost[1]:
+            for (boost_version, cuda_version, mpi_version, python_version,
+                    compiler_version) in itertools.product(boost[1], cuda[1],
+                        mpi[1], python[1], compiler[1]):
                 if boost[0]:
                     rext_deps['boost'] = (boost[0], [boost_version])
-                for cuda_version in cuda[1]:
-                    if cuda[0]:
-                        rext_deps['cuda'] = (cuda[0], [cuda_version])
-                    for mpi_version in mpi[1]:
-                        if mpi[0]:
-                            rext_deps['mpi'] = (mpi[0], [mpi_version])
-                        for python_version in python[1]:
-                            if python[0]:
-                                rext_deps['python'] = (python[0], [python_version])
-                            for compiler_version in compiler[1]:
-                                if compiler[0]:
-                                    rext_deps['compiler'] = (compiler[0], [compiler_version])
-
-                                if self.is_installed(basepath, arch, version[0], rext_deps):
-                                    continue
-
-                                # Recursively building dependencies and creation of module string
-                                build_deps_modules = ''
-                                print('Installing Dependencies for %s/%s.' %(
-                                    self.name(), version[0]))
-
-                                # Check for compiler
-                                if compiler[0]:
-                                    compiler[0].install_version(
-                                        basepath, arch, 'Compiler', compiler_version,
-                                        env, rext_deps)
-                                    build_deps_modules += 'module load %s/%s\n' % (
-                                        compiler[0].name(), compiler_version)
-
-                                # Check for Python
-                                if python[0]:
-                                    python[0].install_version(
-                                        basepath, arch, 'Python', python_version,
-                                        env, rext_deps)
-                                    build_deps_modules += 'module load %s/%s\n' % (
-                                        python[0].name(), python_version)
-
-                                # Check for MPI
-                                if mpi[0]:
-                                    mpi[0].install_version(
-                                        basepath, arch, 'MPI', mpi_version,
-                                        env, rext_deps)
-                                    build_deps_modules += 'module load %s/%s\n' % (
-                                        mpi[0].name(), mpi_version)
-
-                                # Check for CUDA
-                                if cuda[0]:
-                                    cuda[0].install_version(
-                                        basepath, arch, 'CUDA', cuda_version,
-                                        env, rext_deps)
-                                    build_deps_modules += 'module load %s/%s\n' % (
-                                        cuda[0].name(), cuda_version)
-
-                                # Check for Boost
-                                if boost[0]:
-                                    boost[0].install_version(
-                                        basepath, arch, 'Boost', boost_version,
-                                        env, rext_deps)
-                                    build_deps_modules += 'module load %s/%s\n' % (
-                                        cuda[0].name(), boost_version)
-
-                                # Check for other misc deps
-                                for (module, package, pversion) in build_deps:
-                                    package.install_version(basepath, arch, module,
-                                        pversion, env, rext_deps)
-                                    build_deps_modules += 'module load %s/%s\n' % (
-                                        package.name(), pversion)
-
-                                print('Installing Dependencies for %s/%s done.' %(
-                                    self.name(), version[0]))
-
-                                src_idx = 0;
-                                src_dirs={}
-                                for source in version[1:]:
-                                    file_name = download_source(source, source_path)
-                                    src_dir = extract_source(source_path, file_name)
-                                    src_dirs['SRC_DIR%s' % (src_idx)] = src_dir
-                                    src_idx += 1
-
-                                build_env.update(src_dirs)
-                                build_env['BUILD_DIR'] = self.build_dir(source_path, arch,
-                                    version[0], rext_deps)
-                                prefix = self.prefix(basepath, arch,
-                                    version[0], rext_deps)
-                                build_env['PACKAGE_PREFIX'] = prefix
-
-                                shell = subprocess.Popen(['/bin/bash', '-l'], cwd=source_path,
-                                    stdin=subprocess.PIPE, env=build_env)
-                                shell.stdin.write('module purge\n')
-                                shell.stdin.write(build_deps_modules)
-                                shell.stdin.write('module list\n')
-
-                                for step in self.json_data['build']:
-                                    shell.stdin.write('__RET=$?; if [ $__RET != 0 ]; then exit $__RET; else ' + step + '; fi\n')
-
-                                shell.stdin.write('exit $?\n')
-                                shell.stdin.flush()
-                                ret = shell.wait()
-
-                                print('')
-                                if ret != 0:
-                                    print('Installing Package %s/%s failed.' %(
-                                        self.name(), version[0]))
-                                    if os.path.exists(prefix):
-                                        shutil.rmtree(prefix)
-                                    exit(1)
-                                self.write_modulefile(basepath, arch, version[0], rext_deps, build_deps)
-
-        print('Installing Package %s/%s done.' %(
-            self.name(), version[0]))
-
-    def install(self, basepath, arch, module, versions = None):
-        env = os.environ
-        env['COLUMNS'] = '80'
-        env['BUILDIT'] = 'python %s' % (os.path.realpath(__file__))
+                if cuda[0]:
+                    rext_deps['cuda'] = (cuda[0], [cuda_version])
+                if mpi[0]:
+                    rext_deps['mpi'] = (mpi[0], [mpi_version])
+                if python[0]:
+                    rext_deps['python'] = (python[0], [python_version])
+                if compiler[0]:
+                    rext_deps['compiler'] = (compiler[0], [compiler_version])
+
+                node = graph.add(BuildNode(self, module, version, arch,
+                    self.prefix(basepath, arch, version[0], rext_deps),
+                    dict(rext_deps), build_deps, basepath))
+                nodes.append(node)
+
+                if node.expanded:
+                    continue
+                node.expanded = True
+
+                node.installed = self.is_installed(basepath, arch, version[0], rext_deps)
+                if node.installed and not graph.expand_installed:
+                    node.unexpanded = True
+                    continue
+
+                # Expand the dependencies in the same order they get loaded
+                module_deps = [
+                    (compiler, 'Compiler', compiler_version),
+                    (python, 'Python', python_version),
+                    (mpi, 'MPI', mpi_version),
+                    (cuda, 'CUDA', cuda_version),
+                    (boost, 'Boost', boost_version)]
+                for (dep, dmodule, dversion) in module_deps:
+                    if dep[0]:
+                        node.depends_on(dep[0].expand_version(graph, basepath,
+                            arch, dmodule, dversion, node.rext_deps))
+                        node.modules.append((dep[0].name(), dversion))
+
+                for (dmodule, package, pversion) in build_deps:
+                    node.depends_on(package.expand_version(graph, basepath,
+                        arch, dmodule, pversion, node.rext_deps))
+                    node.modules.append((package.name(), pversion))
+
+        return nodes
+
+    def expand(self, graph, basepath, arch, module, versions = None):
         if not versions:
             versions = self.json_data['versions']
+        nodes = []
         for version in versions:
-            self.install_version(basepath, arch, module, version, env)
+            nodes.extend(self.expand_version(graph, basepath, arch, module, version))
+        return nodes
+
+    def install_artifact(self, context, node, build_hash):
+        start = time.time()
+        if not context.artifacts.unpack(build_hash, node.prefix, context.basepath):
+            return False
+        context.event(node, 'install', start, origin='artifact')
+        saved = context.store.deduplicate(node.prefix) if context.store else None
+        modulefile = self.write_modulefile(context.basepath, node.arch,
+            node.version[0], node.rext_deps, node.build_deps,
+            context.modulefile_style)
+        node.write_stamp()
+        record = node.record(modulefile, time.time() - start, 'artifact')
+        record['deduplicated'] = saved
+        installed_db(context.basepath).add(record)
+        append_history(context.basepath, record)
+        print('Installing Package %s/%s from %s done.' %(
+            self.name(), node.version[0], context.artifacts.artifact(build_hash)))
+        return True
+
+    def build(self, context, node):
+        '''
+        Builds a node while holding the lock of its prefix. Concurrent
+        invocations building the same prefix wait for each other, the second
+        one finds the package installed and returns. The sources are fetched
+        first, downloads need neither jobserver tokens nor the lock. The
+        tokens are taken before the lock, a nested build.py always has its
+        implicit token to finish a prefix its parent is waiting for.
+        '''
+        if node.dependency_wait:
+            context.event(node, 'dependency-wait', *node.dependency_wait)
+        src_files = None
+        if not (context.artifacts and context.artifacts.has(node.build_hash())):
+            src_files = self.fetch_sources(context, node)
+        makedirs(os.path.dirname(node.prefix))
+        start = time.time()
+        jobs = context.jobserver.acquire()
+        try:
+            with FileLock(node.prefix + '.lock'):
+                context.event(node, 'slot-wait', start)
+                db = installed_db(context.basepath)
+                db.load()
+                if node.prefix in db:
+                    node.stamp = None
+                    stamp = node.read_stamp()
+                    if not node.stale or (stamp and stamp['hash'] == node.computed_stamp_hash()):
+                        print('Package %s was installed by another process.' % (node))
+                        return True
+                return self.build_locked(context, node, jobs, src_files)
+        finally:
+            context.release_scratch(node)
+            context.jobserver.release(jobs)
+
+    def fetch_sources(self, context, node):
+        src_files = []
+        for source in node.version[1:]:
+            start = time.time()
+            src_files.append(context.fetcher.get(source))
+            context.event(node, 'download', start, url=source_url(source))
+        return src_files
+
+    def build_locked(self, context, node, jobs, src_files=None):
+        basepath = context.basepath
+        version = node.version
+        arch = node.arch
+        rext_deps = node.rext_deps
+
+        print('Installing Package %s/%s.' %(
+            self.name(), version[0]))
 
-    def uninstall_version(self, basepath, arch, module, version, env, ext_deps = None):
-        if type(version) is unicode or type(version) is str:
-            for v in self.json_data['versions']:
-                if v[0] == version:
-                    version = v
-
-        package = self
-        compiler = None
-        mpi = None
-        boost = None
-        cuda = None
-        python = None
-
-        for deps in package.build_deps:
-            for (pmodule, ppackage, pversion) in deps:
-                if pmodule == 'Compiler':
-                    compiler = ppackage
-                elif pmodule == 'MPI':
-                    mpi = ppackage
-                elif module == 'Boost':
-                    boost = ppackage
-                elif module == 'CUDA':
-                    cuda = ppackage
-                elif module == 'Python':
-                    python = ppackage
-
-        extract_versions = lambda p: p.versions() if p else ['*']
+        if node.stale:
+            installed_db(basepath).remove([node.prefix])
+            for path in [node.prefix, node.stamp_file()]:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.exists(path):
+                    os.remove(path)
+        elif os.path.exists(node.prefix):
+            # Left behind by an interrupted build, it never got recorded
+            print('Removing incomplete installation %s' % (node.prefix))
+            shutil.rmtree(node.prefix)
+
+        build_hash = node.build_hash()
+        if context.artifacts and context.artifacts.has(build_hash):
+            if self.install_artifact(context, node, build_hash):
+                return True
+
+        if src_files is None:
+            # The artifact could not be used after all
+            src_files = self.fetch_sources(context, node)
+
+        source_path = context.scratch_dir(node, src_files)
+        if not source_path:
+            source_path = os.path.join(package_path, 'source', self.name(), version[0])
+        makedirs(source_path)
+
+        environment = context.environment(node)
+        build_env = (environment or context.env).copy()
+        build_env['PACKAGE_VERSION'] = str(version[0])
 
-        for arch in architectures:
-            deps = {}
-            for boost_version in extract_versions(boost):
-                if boost:
-                    deps['boost'] = (boost, [boost_version])
-                for cuda_version in extract_versions(cuda):
-                    if cuda:
-                        deps['cuda'] = (cuda, [cuda_version])
-                    for mpi_version in extract_versions(mpi):
-                        if mpi:
-                            deps['mpi'] = (mpi, [mpi_version])
-                        for python_version in extract_versions(python):
-                            if python:
-                                deps['python'] = (python, [python_version])
-                            for compiler_version in extract_versions(compiler):
-                                if compiler:
-                                    deps['compiler'] = (compiler, [compiler_version])
-                                if package.is_installed(basepath, arch, version[0], deps):
-                                    prefix = package.prefix(basepath, arch, version[0], deps)
-                                    shutil.rmtree(prefix)
-                                    deps_dir = self.get_deps_path(deps)
-                                    if deps_dir == '':
-                                        deps_dir = 'Core'
-                                    os.remove(os.path.join(basepath, arch, 'modulefiles', deps_dir, self.name(), '%s.lua' % (version[0])))
-                                    print('    Removed %s: %s (%s, %s)' % (arch, version[0], deps, prefix))
+        build_deps_modules = ''
+        for (name, dversion) in node.modules:
+            build_deps_modules += 'module load %s/%s\n' % (name, dversion)
+
+        src_idx = 0;
+        src_dirs={}
+        for file_name in src_files:
+            start = time.time()
+            src_dir = extract_source(source_path, file_name)
+            context.event(node, 'extract', start, archive=file_name)
+            src_dirs['SRC_DIR%s' % (src_idx)] = src_dir
+            src_idx += 1
+
+        build_env.update(src_dirs)
+        build_env['BUILD_DIR'] = self.build_dir(source_path, arch,
+            version[0], rext_deps)
+        prefix = node.prefix
+        build_env['PACKAGE_PREFIX'] = prefix
+
+        build_env['MAKE_JOBS'] = str(jobs)
+        build_env['BUILD_JOBS'] = str(jobs)
+
+        log_file = node.log_file(basepath)
+        stats_file = log_file[:-len('.log')] + '.ccache'
+        if os.path.exists(stats_file):
+            os.remove(stats_file)
+        if context.compiler_cache:
+            context.compiler_cache.environment(build_env, source_path, stats_file)
+
+        # The output of the build goes to its log, every step is enclosed by
+        # markers to time it
+        steps = self.json_data['build']
+        makedirs(os.path.dirname(log_file))
+        log = open(log_file, 'w')
+        log.write('Building %s\n' % (node))
+        log.write('Sources: %s\n' % (source_path))
+        log.write('Modules: %s (%s)\n' % (' '.join('%s/%s' % module
+            for module in node.modules) or 'none',
+            'lmod' if environment is None else 'computed'))
+        for (index, step) in enumerate(steps):
+            log.write('Step %d: %s\n' % (index, step))
+        log.flush()
+
+        start = time.time()
+        if environment is None:
+            shell = subprocess.Popen(['/bin/bash', '-l'], cwd=source_path,
+                stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT,
+                env=build_env)
+            shell.stdin.write('module purge\n')
+            shell.stdin.write(build_deps_modules)
+            shell.stdin.write('module list\n')
+        else:
+            # The modules are already applied, recipes loading modules
+            # themselves still get Lmod's module command
+            shell = subprocess.Popen(['/bin/bash'], cwd=source_path,
+                stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT,
+                env=build_env)
+            shell.stdin.write('if [ -n "$LMOD_CMD" ] && ! type module > /dev/null 2>&1; then '
+                'module() { eval "$($LMOD_CMD bash "$@")"; }; fi\n')
+
+        for (index, step) in enumerate(steps):
+            shell.stdin.write('echo "%s %d started $(date +%%s.%%N)"\n' % (
+                step_marker, index))
+            shell.stdin.write(step + '\n')
+            shell.stdin.write('__RET=$?; echo "%s %d finished $(date +%%s.%%N) $__RET"; '
+                'if [ $__RET != 0 ]; then exit $__RET; fi\n' % (step_marker, index))
+
+        shell.stdin.write('exit 0\n')
+        shell.stdin.flush()
+        # Reap the shell ourselves to get the resources used by the build
+        (pid, status, usage) = os.wait4(shell.pid, 0)
+        if os.WIFSIGNALED(status):
+            ret = -os.WTERMSIG(status)
+        else:
+            ret = os.WEXITSTATUS(status)
+        shell.returncode = ret
+        log.close()
+        build_time = time.time() - start
+        cpu_time = usage.ru_utime + usage.ru_stime
+
+        for (index, step_start, step_end, status) in step_times(log_file):
+            context.event(node, step_phase(steps[index]), step_start, step_end,
+                step=index, command=steps[index], status=status)
+
+        scratch_size = disk_usage(node.scratch) if node.scratch else None
+        if ret != 0:
+            print('Installing Package %s/%s failed, the last lines of %s:' %(
+                self.name(), version[0], log_file))
+            print(log_tail(log_file, context.log_tail))
+            if os.path.exists(prefix):
+                shutil.rmtree(prefix)
+            return False
+        if context.artifacts:
+            context.artifacts.pack(build_hash, node)
+        saved = None
+        if context.store:
+            start = time.time()
+            saved = context.store.deduplicate(node.prefix)
+            context.event(node, 'deduplicate', start, saved=saved)
+        modulefile = self.write_modulefile(basepath, arch, version[0], rext_deps,
+            node.build_deps, context.modulefile_style)
+        node.write_stamp()
+        record = node.record(modulefile, build_time, 'build', cpu_time, jobs)
+        record['deduplicated'] = saved
+        record['scratch_size'] = scratch_size
+        if context.compiler_cache:
+            record['compiler_cache'] = context.compiler_cache.statistics(stats_file)
+        installed_db(basepath).add(record)
+        append_history(basepath, record)
+
+        print('Installing Package %s/%s done.' %(
+            self.name(), version[0]))
+        if record.get('compiler_cache'):
+            print('    Compiler cache: %(hits)s hits, %(misses)s misses' % (
+                record['compiler_cache']))
+        return True
+
+    def uninstall_version(self, basepath, arch, module, version, env, ext_deps = None):
+        version = self.version_entry(version)
+
+        db = installed_db(basepath)
+        records = db.find(self.name(), version[0], arch)
+        for record in records:
+            prefix = record['prefix']
+            if os.path.exists(prefix):
+                shutil.rmtree(prefix)
+            if os.path.exists(prefix + '.stamp'):
+                os.remove(prefix + '.stamp')
+            if os.path.lexists(record['modulefile']):
+                os.remove(record['modulefile'])
+            print('    Removed %s: %s (%s, %s)' % (arch, version[0],
+                format_deps(record['deps']), prefix))
+        db.remove([record['prefix'] for record in records])
 
     def uninstall(self, basepath, arch, module, versions = None):
         env = os.environ
@@ -652,7 +1721,854 @@ class Package:
         for version in versions:
             self.uninstall_version(basepath, arch, module, version, env)
 
-def load_packages():
+class JobServer:
+    '''
+    A GNU make style jobserver handing out core tokens to concurrent builds.
+    The tokens live in a pipe which is passed on to nested build.py
+    invocations through the environment. Like make, every process owns one
+    additional implicit token, which is what keeps a nested $BUILDIT call from
+    deadlocking while its parent build holds on to its own tokens.
+    '''
+    def __init__(self, tokens = None, jobs = 1):
+        self.lock = threading.Lock()
+        self.implicit = True
+        self.waiting = 0
+        self.read_fd = None
+        self.write_fd = None
+        self.inherited = False
+
+        inherited = os.environ.get('BUILDIT_JOBSERVER')
+        if inherited:
+            try:
+                (read_fd, write_fd, count) = [int(i) for i in inherited.split(',')]
+                os.fstat(read_fd)
+                os.fstat(write_fd)
+                (self.read_fd, self.write_fd, self.tokens) = (read_fd, write_fd, count)
+                self.inherited = True
+            except (ValueError, OSError):
+                print('Ignoring invalid jobserver %s' % (inherited))
+
+        if self.read_fd is None:
+            self.tokens = tokens or multiprocessing.cpu_count()
+            (self.read_fd, self.write_fd) = os.pipe()
+            os.write(self.write_fd, '+' * (self.tokens - 1))
+
+        self.share = max(1, self.tokens // max(1, jobs))
+
+        # A non-blocking descriptor of its own for the opportunistic reads,
+        # setting O_NONBLOCK on the shared one would affect all processes.
+        # Without one only the blocking first token is taken.
+        try:
+            self.nonblocking_fd = os.open('/proc/self/fd/%d' % (self.read_fd),
+                os.O_RDONLY | os.O_NONBLOCK)
+            fcntl.fcntl(self.nonblocking_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        except OSError:
+            self.nonblocking_fd = None
+
+    def environment(self):
+        return {'BUILDIT_JOBSERVER': '%d,%d,%d' % (
+            self.read_fd, self.write_fd, self.tokens)}
+
+    def acquire(self):
+        acquired = 0
+        with self.lock:
+            if self.implicit:
+                self.implicit = False
+                acquired = 1
+            else:
+                self.waiting += 1
+
+        # Block for the first token only, the rest of the share is taken
+        # opportunistically so concurrent builds split the available cores.
+        while acquired == 0:
+            try:
+                if os.read(self.read_fd, 1):
+                    acquired = 1
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+            if acquired:
+                with self.lock:
+                    self.waiting -= 1
+
+        while acquired < self.share and self.nonblocking_fd is not None:
+            try:
+                if not os.read(self.nonblocking_fd, 1):
+                    break
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.EAGAIN:
+                    raise
+                break
+            acquired += 1
+
+        return acquired
+
+    def release(self, count):
+        with self.lock:
+            # Threads blocked on the pipe can't see the implicit token
+            if not self.implicit and self.waiting == 0 and count > 0:
+                self.implicit = True
+                count -= 1
+        if count > 0:
+            os.write(self.write_fd, '+' * count)
+
+class CompilerCache:
+    '''
+    Puts ccache or sccache in front of the compilers of all builds, sharing
+    one cache below the basepath. ccache is used through a directory of
+    symlinks named after the compilers which is put first in PATH, sccache
+    as compiler launcher for CMake.
+    '''
+    compilers = ['cc', 'c++', 'gcc', 'g++', 'clang', 'clang++', 'nvcc']
+
+    def __init__(self, basepath, tool = 'auto'):
+        self.tool = None
+        self.program = None
+        for name in ['ccache', 'sccache']:
+            if tool in ['auto', name]:
+                self.program = find_program(name)
+                if self.program:
+                    self.tool = name
+                    break
+        if not tool in ['auto', 'none'] and not self.tool:
+            print('%s not found, building without a compiler cache' % (tool))
+
+        self.path = state_path(basepath, 'compiler-cache')
+        self.masquerade = os.path.join(self.path, 'bin')
+        if self.tool == 'ccache':
+            makedirs(self.masquerade)
+            for compiler in self.compilers:
+                link = os.path.join(self.masquerade, compiler)
+                if not os.path.islink(link) or os.readlink(link) != self.program:
+                    symlink_atomic(self.program, link)
+
+    def environment(self, env, source_path, stats_file):
+        if self.tool == 'ccache':
+            env['PATH'] = ':'.join([self.masquerade] + [path for path in
+                env.get('PATH', '').split(':') if path and path != self.masquerade])
+            env['CCACHE_DIR'] = os.path.join(self.path, 'ccache')
+            # Paths below the sources are hashed relative to it, builds for
+            # other dependencies can share the results
+            env['CCACHE_BASEDIR'] = source_path
+            env['CCACHE_STATSLOG'] = stats_file
+        elif self.tool == 'sccache':
+            env['SCCACHE_DIR'] = os.path.join(self.path, 'sccache')
+            for language in ['C', 'CXX', 'CUDA']:
+                env['CMAKE_%s_COMPILER_LAUNCHER' % (language)] = self.program
+
+    def statistics(self, stats_file):
+        '''
+        Returns the hits and misses of one build from the ccache stats log,
+        None if there is none.
+        '''
+        if not os.path.exists(stats_file):
+            return None
+        stats = {'hits': 0, 'misses': 0}
+        for line in open(stats_file):
+            line = line.strip()
+            if line.endswith('cache_hit'):
+                stats['hits'] += 1
+            elif line == 'cache_miss':
+                stats['misses'] += 1
+        return stats
+
+class BuildContext:
+    '''
+    The state shared by all builds of one invocation.
+    '''
+    def __init__(self, basepath, env, jobserver, fetcher, artifacts = None,
+            log_tail = 20, lmod = False, compiler_cache = None, store = None,
+            modulefile_style = 'resolved', scratch = None):
+        self.basepath = basepath
+        self.modulefile_style = modulefile_style
+        self.scratch = scratch
+        self.scratch_reserved = {}
+        self.scratch_lock = threading.Lock()
+        self.store = store
+        self.compiler_cache = compiler_cache
+        self.env = env
+        self.jobserver = jobserver
+        self.fetcher = fetcher
+        self.artifacts = artifacts
+        self.log_tail = log_tail
+        self.lmod = lmod
+        self.environments = {}
+        self.environments_lock = threading.Lock()
+
+    def environment(self, node):
+        '''
+        Returns the environment to build node in, the clean environment with
+        the modules of its dependencies applied. It is computed once for every
+        set of dependencies. None if the modules have to be loaded by Lmod.
+        '''
+        if self.lmod:
+            return None
+        key = tuple(dep.prefix for dep in node.deps)
+        with self.environments_lock:
+            if not key in self.environments:
+                changes = node.load_environment(installed_db(self.basepath))
+                env = None
+                if changes is not None:
+                    env = dict(self.env)
+                    apply_environment(env, changes)
+                self.environments[key] = env
+            return self.environments[key]
+
+    def scratch_dir(self, node, archives):
+        '''
+        Creates the directory on scratch node gets extracted and built in.
+        The space needed is estimated from earlier builds of the package, or
+        from the size of its archives. Returns None, to build next to the
+        sources as usual, without scratch or if it is too full.
+        '''
+        if not self.scratch:
+            return None
+        sizes = [record.get('scratch_size') or 0 for record in
+            installed_db(self.basepath).find(node.package.name())]
+        needed = max(sizes + [10 * sum(os.path.getsize(archive)
+            for archive in archives)])
+        with self.scratch_lock:
+            scratch_stat = os.statvfs(self.scratch)
+            available = scratch_stat.f_bavail * scratch_stat.f_frsize - sum(
+                self.scratch_reserved.values())
+            if needed > available:
+                print('Building %s without scratch, %s needs %s but only %s are free' % (
+                    node, self.scratch, format_size(needed), format_size(max(0, available))))
+                return None
+            self.scratch_reserved[node.prefix] = needed
+        node.scratch = tempfile.mkdtemp(prefix='%s-%s-' % (node.package.name(),
+            node.version[0]), dir=self.scratch)
+        return node.scratch
+
+    def release_scratch(self, node):
+        if node.scratch:
+            shutil.rmtree(node.scratch, ignore_errors=True)
+            node.scratch = None
+        with self.scratch_lock:
+            self.scratch_reserved.pop(node.prefix, None)
+
+    def event(self, node, phase, start, end = None, **data):
+        if end is None:
+            end = time.time()
+        data.update({'phase': phase, 'name': node.package.name(),
+            'version': node.version[0], 'prefix': node.prefix,
+            'start': start, 'duration': end - start})
+        append_event(self.basepath, data)
+
+class BuildNode:
+    def __init__(self, package, module, version, arch, prefix, rext_deps,
+            build_deps, basepath):
+        self.package = package
+        self.basepath = basepath
+        self.module = module
+        self.version = version
+        self.arch = arch
+        self.prefix = prefix
+        self.rext_deps = rext_deps
+        self.build_deps = build_deps
+        self.modules = []
+        self.deps = []
+        self.dependents = []
+        self.expanded = False
+        self.installed = False
+        self.stale = False
+        self.stamp = None
+        self.computed_hash = None
+        self.computed_build_hash = None
+        self.unexpanded = False
+        self.dependency_wait = None
+        self.scratch = None
+
+    def __str__(self):
+        deps_dir = self.package.get_deps_path(self.rext_deps)
+        if deps_dir == '':
+            deps_dir = 'Core'
+        return '%s/%s (%s, %s)' % (self.package.name(), self.version[0],
+            self.arch, deps_dir)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def build_hash(self):
+        '''
+        Identifies the result of a build by the recipe, the sources and the
+        versions of everything it was built against. The build hashes of the
+        dependencies are included, so changing the recipe of a dependency
+        changes the hash of all its dependents.
+        '''
+        if self.computed_build_hash is None and self.unexpanded:
+            # Without its dependencies the hash is the one recorded when it
+            # was built
+            stamp = self.read_stamp() or {}
+            record = installed_db(self.basepath).get(self.prefix) or {}
+            self.computed_build_hash = stamp.get('build_hash') or record.get('build_hash')
+        if self.computed_build_hash is None:
+            deps = self.dep_versions()
+            sources = [source_sha256(source) or source_url(source)
+                for source in self.version[1:]]
+            content = json.dumps([self.package.name(), self.version[0], self.arch,
+                self.package.get_data('build'), sources, deps,
+                ['%s/%s' % module for module in self.modules],
+                sorted(dep.build_hash() for dep in self.deps)], sort_keys=True)
+            self.computed_build_hash = hashlib.sha256(content).hexdigest()
+        return self.computed_build_hash
+
+    def stamp_file(self):
+        return self.prefix + '.stamp'
+
+    def log_file(self, basepath):
+        return state_path(basepath, 'logs',
+            os.path.relpath(self.prefix, basepath) + '.log')
+
+    def read_stamp(self):
+        if self.stamp is None:
+            try:
+                self.stamp = json.load(open(self.stamp_file()))
+            except (IOError, ValueError):
+                return None
+        return self.stamp
+
+    def computed_stamp_hash(self):
+        if self.computed_hash is None:
+            content = json.dumps([self.build_hash(),
+                sorted(dep.stamp_hash() for dep in self.deps)])
+            self.computed_hash = hashlib.sha256(content).hexdigest()
+        return self.computed_hash
+
+    def stamp_hash(self):
+        '''
+        The hash an up to date installation of this node has in its stamp. It
+        covers the build hash and the stamp hashes of all dependencies, so
+        rebuilding a node changes the hash of all its dependents.
+        '''
+        if self.installed and not self.stale:
+            stamp = self.read_stamp()
+            if stamp:
+                return stamp['hash']
+        return self.computed_stamp_hash()
+
+    def write_stamp(self):
+        stamp = {
+            'hash': self.computed_stamp_hash(),
+            'build_hash': self.build_hash(),
+            'recipe_hash': self.package.recipe_hash(),
+            'deps': dict((dep.prefix, dep.stamp_hash()) for dep in self.deps)
+        }
+        write_file_atomic(self.stamp_file(), json.dumps(stamp, sort_keys=True,
+            indent=4) + '\n')
+        self.stamp = stamp
+
+    def dep_versions(self):
+        deps = {}
+        for name in self.rext_deps:
+            (package, versions) = self.rext_deps[name]
+            deps[name] = [package.name(), versions[0]]
+        return deps
+
+    def record(self, modulefile, build_time = None, origin = None,
+            cpu_time = None, jobs = None):
+        deps = self.dep_versions()
+        return {
+            'package': self.package.name(),
+            'module': self.module,
+            'version': self.version[0],
+            'arch': self.arch,
+            'deps': deps,
+            'modules': ['%s/%s' % module for module in self.modules],
+            'requires': [dep.prefix for dep in self.deps],
+            'prefix': self.prefix,
+            'modulefile': modulefile,
+            'environment': self.module_environment(),
+            'build_time': build_time,
+            'cpu_time': cpu_time,
+            'jobs': jobs,
+            'installed': time.time(),
+            'recipe_hash': self.package.recipe_hash() if build_time is not None else None,
+            'build_hash': self.build_hash() if build_time is not None else None,
+            'origin': origin
+        }
+
+    def module_environment(self):
+        return self.package.module_environment(self.basepath, self.arch,
+            self.prefix, self.version[0], self.rext_deps)
+
+    def load_environment(self, db):
+        '''
+        Returns the environment changes of loading the modules of all
+        dependencies, the dependencies of a dependency before itself. None
+        if an installation has no recorded environment.
+        '''
+        changes = []
+        visited = set()
+        def visit(prefix):
+            if prefix in visited:
+                return True
+            visited.add(prefix)
+            record = db.get(prefix)
+            if record is None or record.get('environment') is None:
+                return False
+            for dep in record['requires']:
+                if not visit(dep):
+                    return False
+            changes.extend(record['environment'])
+            return True
+        for dep in self.deps:
+            if not visit(dep.prefix):
+                return None
+        return changes
+
+    def depends_on(self, nodes):
+        for node in nodes:
+            if node is self or node in self.deps:
+                continue
+            self.deps.append(node)
+            node.dependents.append(self)
+
+class BuildGraph:
+    '''
+    The explicit graph of all builds needed for a set of targets. Nodes are
+    identified by their installation prefix, so every package version gets
+    built exactly once per dependency combination.
+    '''
+    def __init__(self, expand_installed = False):
+        self.nodes = {}
+        self.order = []
+        self.expand_installed = expand_installed
+
+    def add(self, node):
+        if node.prefix in self.nodes:
+            return self.nodes[node.prefix]
+        self.nodes[node.prefix] = node
+        self.order.append(node)
+        return node
+
+    def topological(self):
+        remaining = dict((node.prefix, len(node.deps)) for node in self.order)
+        ready = [node for node in self.order if remaining[node.prefix] == 0]
+        result = []
+        while ready:
+            node = ready.pop(0)
+            result.append(node)
+            for dependent in node.dependents:
+                remaining[dependent.prefix] -= 1
+                if remaining[dependent.prefix] == 0:
+                    ready.append(dependent)
+
+        if len(result) != len(self.order):
+            cycle = [node for node in self.order if remaining[node.prefix] > 0]
+            raise Exception('Dependency cycle detected between %s' % (cycle))
+        return result
+
+    def pending(self):
+        return [node for node in self.topological() if not node.installed]
+
+    def mark_stale(self):
+        stale = []
+        for node in self.topological():
+            if not node.installed:
+                continue
+            stamp = node.read_stamp()
+            if stamp is None or stamp['hash'] != node.computed_stamp_hash():
+                node.stale = True
+                node.installed = False
+                stale.append(node)
+        return stale
+
+    def sources(self, artifacts = None):
+        sources = []
+        for node in self.pending():
+            if artifacts and artifacts.has(node.build_hash()):
+                continue
+            sources.extend(node.version[1:])
+        return sources
+
+class Scheduler:
+    '''
+    Runs the pending nodes of a BuildGraph in a bounded pool of worker threads.
+    A node is started as soon as all of its dependencies have been built. After
+    a failure no new builds are started, unless keep_going is set in which
+    case only the nodes depending on the failed one are skipped.
+    '''
+    def __init__(self, graph, jobs = 1, keep_going = False):
+        self.graph = graph
+        self.jobs = max(1, jobs)
+        self.keep_going = keep_going
+
+    def run(self, build):
+        pending = self.graph.pending()
+        remaining = {}
+        for node in pending:
+            remaining[node.prefix] = len(
+                [dep for dep in node.deps if not dep.installed])
+        ready = [node for node in pending if remaining[node.prefix] == 0]
+        started = time.time()
+        for node in ready:
+            node.dependency_wait = (started, started)
+
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+
+        def worker():
+            while True:
+                node = tasks.get()
+                if node is None:
+                    return
+                try:
+                    ok = build(node)
+                except Exception:
+                    traceback.print_exc()
+                    ok = False
+                results.put((node, ok))
+
+        workers = []
+        for i in range(min(self.jobs, max(1, len(pending)))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            workers.append(thread)
+
+        running = 0
+        done = []
+        failed = []
+        skipped = {}
+        try:
+            while ready or running:
+                while ready and running < self.jobs and (self.keep_going or not failed):
+                    tasks.put(ready.pop(0))
+                    running += 1
+                if running == 0:
+                    break
+
+                try:
+                    (node, ok) = results.get(True, 1)
+                except Queue.Empty:
+                    continue
+                running -= 1
+
+                if not ok:
+                    failed.append(node)
+                    blocked = list(node.dependents)
+                    while blocked:
+                        dependent = blocked.pop()
+                        if dependent.prefix in remaining and not dependent.prefix in skipped:
+                            skipped[dependent.prefix] = (dependent, node)
+                            blocked.extend(dependent.dependents)
+                    continue
+                done.append(node)
+                node.installed = True
+                for dependent in node.dependents:
+                    if dependent.prefix not in remaining:
+                        continue
+                    remaining[dependent.prefix] -= 1
+                    if remaining[dependent.prefix] == 0:
+                        dependent.dependency_wait = (started, time.time())
+                        ready.append(dependent)
+        finally:
+            for thread in workers:
+                tasks.put(None)
+            for thread in workers:
+                thread.join()
+
+        return (done, failed, [skipped[node.prefix] for node in pending
+            if node.prefix in skipped])
+
+class WorkQueue:
+    '''
+    A build queue shared by worker processes on one or more hosts which see
+    the same basepath. The state of every node lives in a JSON file that is
+    only read and written while holding a lock. Nodes are identified by their
+    prefix and move from pending over claimed to done, failed or skipped.
+    Every worker process touches a heartbeat file, the claims of a worker
+    which stopped doing so are put back to pending.
+    '''
+    WAIT = 'wait'
+
+    def __init__(self, basepath, name):
+        self.path = state_path(basepath, 'queue', name)
+        self.state_file = os.path.join(self.path, 'state.json')
+        self.lock = FileLock(os.path.join(self.path, 'lock'))
+        self.heartbeat_file = self.worker_file(socket.gethostname(), os.getpid())
+
+    def worker_file(self, host, pid):
+        return os.path.join(self.path, 'workers', '%s-%d' % (host, pid))
+
+    def heartbeat(self):
+        makedirs(os.path.dirname(self.heartbeat_file))
+        open(self.heartbeat_file, 'a').close()
+        os.utime(self.heartbeat_file, None)
+
+    def stop(self):
+        if os.path.exists(self.heartbeat_file):
+            os.remove(self.heartbeat_file)
+
+    def responding(self, host, pid):
+        '''
+        Whether the worker process pid on host is still alive. Heartbeats are
+        compared by the modification times of the files, which are set by the
+        same file server, so clocks of the hosts don't need to agree.
+        '''
+        if host == socket.gethostname():
+            try:
+                os.kill(pid, 0)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    return False
+        try:
+            last = os.path.getmtime(self.worker_file(host, pid))
+        except OSError:
+            return False
+        self.heartbeat()
+        return os.path.getmtime(self.heartbeat_file) - last < queue_worker_timeout
+
+    def load(self):
+        if not os.path.exists(self.state_file):
+            return None
+        return json.load(open(self.state_file))
+
+    def save(self, state):
+        write_file_atomic(self.state_file, json.dumps(state, sort_keys=True,
+            indent=4, separators=(',', ': ')) + '\n')
+
+    def submit(self, graph):
+        with self.lock:
+            state = self.load()
+            finished = ['done', 'failed', 'skipped']
+            if state is None or all(node['state'] in finished
+                    for node in state['nodes'].values()):
+                state = {'created': time.time(), 'order': [], 'nodes': {}}
+
+            for node in graph.pending():
+                if node.prefix in state['nodes']:
+                    continue
+                state['order'].append(node.prefix)
+                state['nodes'][node.prefix] = {
+                    'name': str(node),
+                    'requires': [dep.prefix for dep in node.deps if not dep.installed],
+                    'state': 'pending',
+                    'worker': None
+                }
+            self.save(state)
+
+    def claim(self, worker, candidates):
+        '''
+        Claims a pending node out of candidates whose dependencies are done.
+        Returns WAIT if nodes are still being worked on, None if nothing is
+        left to do.
+        '''
+        with self.lock:
+            state = self.load()
+            nodes = state['nodes']
+            hostname = socket.gethostname()
+
+            responding = {}
+            for prefix in state['order']:
+                node = nodes[prefix]
+                # Requeue claims of workers that died
+                if node['state'] == 'claimed':
+                    worker_id = (node['host'], node['pid'])
+                    if not worker_id in responding:
+                        responding[worker_id] = self.responding(*worker_id)
+                    if not responding[worker_id]:
+                        print('Requeueing %s, worker %s stopped responding' % (
+                            node['name'], node['worker']))
+                        node['state'] = 'pending'
+                if node['state'] != 'pending':
+                    continue
+                states = [nodes[dep]['state'] if dep in nodes else 'done'
+                    for dep in node['requires']]
+                if 'failed' in states or 'skipped' in states:
+                    node['state'] = 'skipped'
+
+            waiting = False
+            claimed = None
+            for prefix in state['order']:
+                node = nodes[prefix]
+                if node['state'] == 'claimed':
+                    waiting = True
+                if node['state'] != 'pending':
+                    continue
+                waiting = True
+                if claimed or not prefix in candidates:
+                    continue
+                if all(nodes[dep]['state'] == 'done' for dep in node['requires']
+                        if dep in nodes):
+                    node.update({'state': 'claimed', 'worker': worker,
+                        'host': hostname, 'pid': os.getpid(),
+                        'claimed': time.time()})
+                    claimed = prefix
+
+            self.save(state)
+            if claimed:
+                return claimed
+            return WorkQueue.WAIT if waiting else None
+
+    def finish(self, prefix, ok):
+        with self.lock:
+            state = self.load()
+            state['nodes'][prefix]['state'] = 'done' if ok else 'failed'
+            state['nodes'][prefix]['finished'] = time.time()
+            self.save(state)
+
+    def summary(self):
+        with self.lock:
+            state = self.load()
+        counts = {}
+        for node in state['nodes'].values():
+            counts[node['state']] = counts.get(node['state'], 0) + 1
+        return (state, counts)
+
+def registry_files():
+    files = [os.path.realpath(__file__)]
+    for module in os.listdir(package_path):
+        module_path = os.path.join(package_path, module)
+        if not os.path.isdir(module_path):
+            continue
+        for package in os.listdir(module_path):
+            if package.endswith('.json'):
+                files.append(os.path.join(module_path, package))
+    return files
+
+def file_digest(file_name):
+    digest = hashlib.sha256()
+    f = open(file_name, 'rb')
+    while True:
+        buffer = f.read(1024 * 1024)
+        if not buffer:
+            break
+        digest.update(buffer)
+    f.close()
+    return digest.hexdigest()
+
+def save_registry_cache(fingerprints):
+    tmp_name = '%s.tmp-%d' % (registry_cache, os.getpid())
+    try:
+        if not os.path.exists(os.path.dirname(registry_cache)):
+            os.makedirs(os.path.dirname(registry_cache))
+        f = open(tmp_name, 'wb')
+        cPickle.dump((fingerprints, packages), f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp_name, registry_cache)
+    except (IOError, OSError) as e:
+        print('Could not write package cache %s: %s' % (registry_cache, e))
+
+def load_registry_cache():
+    '''
+    Returns the cached package registry if none of the package files changed
+    since it was written. A file whose modification time changed is hashed, so
+    touching a file doesn't invalidate the cache. Nested $BUILDIT invocations
+    trust the cache their parent validated and skip the check altogether.
+    '''
+    try:
+        f = open(registry_cache, 'rb')
+        (fingerprints, cached) = cPickle.load(f)
+        f.close()
+    except Exception:
+        return None
+
+    if os.environ.get('BUILDIT_REGISTRY') == registry_cache:
+        return cached
+
+    files = registry_files()
+    if set(files) != set(fingerprints):
+        return None
+
+    changed = False
+    for file_name in files:
+        file_stat = os.stat(file_name)
+        (mtime, size, digest) = fingerprints[file_name]
+        if (file_stat.st_mtime, file_stat.st_size) == (mtime, size):
+            continue
+        if file_digest(file_name) != digest:
+            return None
+        fingerprints[file_name] = (file_stat.st_mtime, file_stat.st_size, digest)
+        changed = True
+
+    if changed:
+        packages.update(cached)
+        packages.index()
+        save_registry_cache(fingerprints)
+    return cached
+
+def package_files():
+    '''
+    Returns the module and file of every package by name, taken from the
+    file names without reading them.
+    '''
+    files = {}
+    for module in sorted(os.listdir(package_path)):
+        module_path = os.path.join(package_path, module)
+        if not os.path.isdir(module_path):
+            continue
+        for package in sorted(os.listdir(module_path)):
+            if package.endswith('.json'):
+                files.setdefault(package[:-len('.json')],
+                    (module, os.path.join(module_path, package)))
+    return files
+
+def load_package_file(package_file):
+    json_data = open(package_file)
+    try:
+        package_data = json.load(json_data)
+        package_data['name']
+        return Package(package_data)
+    except:
+        print ('Could not load ' + package_file)
+        return None
+    finally:
+        json_data.close()
+
+def load_targets(targets):
+    '''
+    Loads only the packages needed to build targets, the target and all of
+    its dependencies. A dependency on a module loads all of its packages.
+    '''
+    files = package_files()
+    pending = [targets.split('/')[0]]
+    loaded = set()
+    while pending:
+        name = pending.pop()
+        if name in loaded:
+            continue
+        loaded.add(name)
+        if name in modules:
+            pending.extend(n for n in files if files[n][0] == name)
+            continue
+        if not name in files:
+            continue
+        (module, package_file) = files[name]
+        package = load_package_file(package_file)
+        if package is None:
+            continue
+        packages.setdefault(module, {})[package.name()] = package
+        for dep in package.get_data('dependencies') or []:
+            pending.append(dep.lstrip('+').split('/')[0])
+
+    for module in modules:
+        packages.setdefault(module, {})
+    packages.index()
+    for module in packages:
+        for name in packages[module]:
+            packages[module][name].resolve_dependencies()
+
+def load_packages(targets = 'all'):
+    if targets != 'all':
+        load_targets(targets)
+        return
+
+    packages.complete = True
+    cached = load_registry_cache()
+    if cached is not None:
+        packages.update(cached)
+        packages.index()
+        return
+
+    fingerprints = {}
+    for file_name in registry_files():
+        file_stat = os.stat(file_name)
+        fingerprints[file_name] = (file_stat.st_mtime, file_stat.st_size, file_digest(file_name))
+
     for module in os.listdir(package_path):
         module_path = os.path.join(package_path, module)
 
@@ -665,74 +2581,554 @@ def load_packages():
         for package in os.listdir(module_path):
             package_file = os.path.join(module_path, package)
             if package_file.endswith('.json'):
-                json_data = open(package_file)
-                try:
-                    package_data = json.load(json_data)
-
-                    packages[module][package_data['name']] = Package(package_data)
-                except:
-                    print ('Could not load ' + package_file)
+                package = load_package_file(package_file)
+                if package is not None:
+                    packages[module][package.name()] = package
 
+    packages.index()
     for module in packages:
         for name in packages[module]:
             packages[module][name].resolve_dependencies()
 
+    save_registry_cache(fingerprints)
+
 def list_installed(basepath):
     print ('Listing installed packages in ' + basepath)
+    db = installed_db(basepath)
     for module in packages:
         for name in packages[module]:
-            package = packages[module][name]
             print('%s/%s:' % (module, name))
-            compiler = None
-            mpi = None
-            boost = None
-            cuda = None
-            python = None
-
-            for deps in package.build_deps:
-                for (pmodule, ppackage, pversion) in deps:
-                    if pmodule == 'Compiler':
-                        compiler = ppackage
-                    elif pmodule == 'MPI':
-                        mpi = ppackage
-                    elif module == 'Boost':
-                        boost = ppackage
-                    elif module == 'CUDA':
-                        cuda = ppackage
-                    elif module == 'Python':
-                        python = ppackage
-
-            extract_versions = lambda p: p.versions() if p else ['*']
-
-            for arch in architectures:
-                for version in package.versions():
-                    deps = {}
-                    for boost_version in extract_versions(boost):
-                        if boost:
-                            deps['boost'] = (boost, [boost_version])
-                        for cuda_version in extract_versions(cuda):
-                            if cuda:
-                                deps['cuda'] = (cuda, [cuda_version])
-                            for mpi_version in extract_versions(mpi):
-                                if mpi:
-                                    deps['mpi'] = (mpi, [mpi_version])
-                                for python_version in extract_versions(python):
-                                    if python:
-                                        deps['python'] = (python, [python_version])
-                                    for compiler_version in extract_versions(compiler):
-                                        if compiler:
-                                            deps['compiler'] = (compiler, [compiler_version])
-                                        if package.is_installed(basepath, arch, version, deps):
-                                            print('    %s: %s (%s)' % (arch, version, deps))
+            for record in db.find(name):
+                print('    %s: %s (%s)' % (record['arch'], record['version'],
+                    format_deps(record['deps'])))
+
+def reindex(basepath):
+    '''
+    Rebuilds the manifest of installed builds by probing every prefix of the
+    build matrix on the file system.
+    '''
+    print ('Indexing installed packages in ' + basepath)
+    if not packages.complete:
+        load_packages()
+    if not basepath in install_dbs:
+        install_dbs[basepath] = InstallDB(basepath)
+    db = install_dbs[basepath]
+    previous = db.records
+    db.records = {}
+
+    graph = BuildGraph()
+    for arch in architectures:
+        for module in packages:
+            for name in packages[module]:
+                packages[module][name].expand(graph, basepath, arch, module)
+
+    records = []
+    for node in graph.order:
+        if not os.path.isdir(node.prefix):
+            continue
+        if node.prefix in previous:
+            record = previous[node.prefix]
+            if record.get('environment') is None:
+                record['environment'] = node.module_environment()
+            records.append(record)
+            continue
+        modulefile = node.package.modulefile(basepath, node.arch,
+            node.version[0], node.rext_deps)
+        records.append(node.record(modulefile))
+
+    for node in graph.topological():
+        if os.path.isdir(node.prefix) and node.read_stamp() is None:
+            node.write_stamp()
+    db.replace(records)
+    print ('Found %s installed packages' % (len(records)))
+
+def module_subtree(basepath, arch, modulefile):
+    modulefiles = os.path.join(basepath, arch, 'modulefiles')
+    return os.path.relpath(modulefile, modulefiles).split(os.sep)[0]
+
+def node_subtrees(basepath, nodes):
+    return set((node.arch, module_subtree(basepath, node.arch,
+        node.package.modulefile(basepath, node.arch, node.version[0],
+        node.rext_deps))) for node in nodes)
+
+def lmod_spider_cache(basepath, arch):
+    '''
+    Regenerates the Lmod spider cache of all modulefiles of an architecture
+    with Lmod's spider, if it can be found through LMOD_DIR. Spider starts at
+    Core and follows the MODULEPATH extensions of the modulefiles, so the
+    cache keeps the hierarchy. Lmod only reads caches listed in the
+    scDescriptT of its lmodrc.lua, one listing all of them is written next to
+    the caches.
+    '''
+    spider = os.path.join(os.environ.get('LMOD_DIR', ''), 'spider')
+    if not 'LMOD_DIR' in os.environ or not os.access(spider, os.X_OK):
+        return None
+    core = os.path.join(basepath, arch, 'modulefiles', 'Core')
+    if not os.path.isdir(core):
+        return None
+
+    cache_path = lmod_cache or state_path(basepath, 'lmod-cache')
+    cache_dir = os.path.join(cache_path, arch)
+    tmp_dir = '%s.tmp-%d' % (cache_dir, os.getpid())
+    makedirs(tmp_dir)
+    ret = subprocess.call([spider, '-o', 'spiderT,reverseMapT', '--dir', tmp_dir, core])
+    if ret != 0:
+        print('Could not update the Lmod spider cache of %s' % (core))
+        shutil.rmtree(tmp_dir)
+        return None
+    old_dir = '%s.old-%d' % (cache_dir, os.getpid())
+    if os.path.exists(cache_dir):
+        os.rename(cache_dir, old_dir)
+    os.rename(tmp_dir, cache_dir)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    write_file_atomic(cache_dir + '.timestamp', '%s\n' % (time.time()))
+
+    lmodrc = os.path.join(cache_path, 'lmodrc.lua')
+    content = 'propT = {}\nscDescriptT = {\n'
+    for name in sorted(os.listdir(cache_path)):
+        if os.path.exists(os.path.join(cache_path, name + '.timestamp')):
+            content += '   {\n      ["dir"] = "%s",\n      ["timestamp"] = "%s",\n   },\n' % (
+                os.path.join(cache_path, name), os.path.join(cache_path, name + '.timestamp'))
+    content += '}\n'
+    if not os.path.exists(lmodrc) or open(lmodrc).read() != content:
+        write_file_atomic(lmodrc, content)
+        print('Lmod uses the spider caches with LMOD_RC=%s, or with its scDescriptT '
+            'in the lmodrc.lua of the site' % (lmodrc))
+    return cache_dir
+
+def refresh_module_cache(basepath, changed = None, spider = True):
+    '''
+    Rewrites the module index of the modulefile subtrees in changed, a set of
+    (arch, subtree) pairs, or of all subtrees. Every subtree, like Core or
+    gcc-6.2.0-openmpi-2.0.1, has its own file below .buildit/module-index
+    with the modules of the installed packages, which are combined into a
+    moduleT.json per architecture. The Lmod spider cache can only be
+    generated as a whole, it is regenerated for each architecture with
+    changes.
+    '''
+    db = installed_db(basepath)
+    with db.lock:
+        db.load()
+    records = {}
+    for record in db.find():
+        if not record.get('modulefile'):
+            continue
+        key = (record['arch'], module_subtree(basepath, record['arch'],
+            record['modulefile']))
+        records.setdefault(key, []).append(record)
+
+    index_dir = state_path(basepath, 'module-index')
+    if changed is None:
+        changed = set(records)
+        for arch in architectures:
+            if os.path.isdir(os.path.join(index_dir, arch)):
+                for file_name in os.listdir(os.path.join(index_dir, arch)):
+                    if file_name.endswith('.json') and file_name != 'moduleT.json':
+                        changed.add((arch, file_name[:-len('.json')]))
+    if not changed:
+        return
+    # Installations which predate the index get all of their subtrees indexed
+    for arch in set(arch for (arch, subtree) in changed):
+        if not os.path.isdir(os.path.join(index_dir, arch)):
+            changed = changed | set(key for key in records if key[0] == arch)
+
+    for (arch, subtree) in changed:
+        file_name = os.path.join(index_dir, arch, subtree + '.json')
+        modules = {}
+        for record in records.get((arch, subtree), []):
+            modules['%s/%s' % (record['package'], record['version'])] = {
+                'file': record['modulefile'],
+                'name': record['package'],
+                'version': record['version'],
+                'prefix': record['prefix'],
+                'deps': format_deps(record['deps']),
+                'requires': record['modules']
+            }
+        if modules:
+            makedirs(os.path.dirname(file_name))
+            write_file_atomic(file_name, json.dumps(modules, sort_keys=True, indent=1) + '\n')
+        elif os.path.exists(file_name):
+            os.remove(file_name)
+
+    for arch in set(arch for (arch, subtree) in changed):
+        arch_dir = os.path.join(index_dir, arch)
+        makedirs(arch_dir)
+        moduleT = {}
+        for file_name in sorted(os.listdir(arch_dir)):
+            if file_name.endswith('.json') and file_name != 'moduleT.json':
+                subtree = os.path.join(basepath, arch, 'modulefiles',
+                    file_name[:-len('.json')])
+                moduleT[subtree] = json.load(open(os.path.join(arch_dir, file_name)))
+        write_file_atomic(os.path.join(arch_dir, 'moduleT.json'),
+            json.dumps(moduleT, sort_keys=True, indent=1) + '\n')
+        print('Updated the module index %s' % (os.path.join(arch_dir, 'moduleT.json')))
+        if spider:
+            cache_dir = lmod_spider_cache(basepath, arch)
+            if cache_dir:
+                print('Updated the Lmod spider cache %s' % (cache_dir))
+
+def deduplicate(basepath, mode):
+    print ('Deduplicating installed packages in %s' % (basepath))
+    store = ContentStore(basepath, mode)
+    total = 0
+    for record in installed_db(basepath).find():
+        if not os.path.isdir(record['prefix']):
+            continue
+        saved = store.deduplicate(record['prefix'])
+        if saved:
+            print('    %s: %s' % (record['prefix'], format_size(saved)))
+        total += saved
+    print ('Saved %s' % (format_size(total)))
+
+def regenerate_modulefiles(basepath, targets, arch, jobs = 8, style = 'resolved'):
+    '''
+    Rewrites the modulefiles of the installed builds of targets from the
+    current recipes, without building anything. Builds sharing a generic
+    modulefile are handled by the same thread, so it is written only once.
+    '''
+    print ('Regenerating modulefiles of \'%s\' in %s' % (targets, basepath))
+    db = installed_db(basepath)
+    versions = None
+    if targets == 'all':
+        regenerate_packages = packages
+    else:
+        (module, package, version) = find_package(targets)
+        if not package:
+            print('Could not find package %s' % (targets))
+            exit(1)
+        if version != '*':
+            versions = [version]
+        regenerate_packages = {module: {package.name(): package}}
+
+    graph = BuildGraph()
+    nodes = []
+    for a in (architectures if arch == 'all' else [arch]):
+        for module in regenerate_packages:
+            for name in regenerate_packages[module]:
+                nodes.extend(regenerate_packages[module][name].expand(graph,
+                    basepath, a, module, versions))
+
+    groups = {}
+    for node in nodes:
+        if not node.prefix in db:
+            continue
+        key = (node.package.name(), node.arch, node.package.get_deps_path(node.rext_deps))
+        groups.setdefault(key, []).append(node)
+
+    tasks = Queue.Queue()
+    for key in sorted(groups):
+        tasks.put(groups[key])
+    lock = threading.Lock()
+    environments = {}
+    failed = []
+
+    def worker():
+        while True:
+            try:
+                nodes = tasks.get(False)
+            except Queue.Empty:
+                return
+            for (index, node) in enumerate(nodes):
+                try:
+                    node.package.write_modulefile(basepath, node.arch,
+                        node.version[0], node.rext_deps, node.build_deps,
+                        style, index == 0)
+                    environment = node.module_environment()
+                    with lock:
+                        environments[node.prefix] = environment
+                except (IOError, OSError) as e:
+                    print('Could not write the modulefile of %s: %s' % (node, e))
+                    with lock:
+                        failed.append(node)
+
+    workers = []
+    for i in range(min(max(1, jobs), max(1, len(groups)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+    for thread in workers:
+        thread.join()
+
+    with db.lock:
+        db.load()
+        for prefix in environments:
+            if prefix in db.records:
+                db.records[prefix]['environment'] = environments[prefix]
+        db.save()
+    nodes = [node for key in groups for node in groups[key]]
+    refresh_module_cache(basepath, node_subtrees(basepath, nodes))
+    print ('Regenerated %s modulefiles' % (len(environments)))
+    if failed:
+        exit(1)
+
+def cache_entries(artifacts = None):
+    '''
+    Returns the downloaded archives and artifacts as (last use, size, paths)
+    tuples, the least recently used first.
+    '''
+    entries = []
+    downloads = os.path.join(download_cache, 'sha256')
+    if os.path.isdir(downloads):
+        for checksum in os.listdir(downloads):
+            path = os.path.join(downloads, checksum)
+            files = [os.path.join(path, name) for name in os.listdir(path)]
+            entries.append((max([os.path.getmtime(path)] + [os.path.getmtime(file_name)
+                for file_name in files]), disk_usage(path), [path]))
+    if artifacts and os.path.isdir(artifacts):
+        for bucket in os.listdir(artifacts):
+            path = os.path.join(artifacts, bucket)
+            if not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                if not name.endswith('.tar.gz'):
+                    continue
+                artifact = os.path.join(path, name)
+                metadata = artifact[:-len('.tar.gz')] + '.json'
+                entries.append((os.path.getmtime(artifact),
+                    os.lstat(artifact).st_blocks * 512, [artifact, metadata]))
+    return sorted(entries)
+
+def gc(basepath, artifacts = None, keep_under = None, dry_run = False,
+        jobs = 8):
+    '''
+    Reports the disk usage of every installed build and removes what is no
+    longer needed: the build trees of installed builds, the extracted
+    sources of versions without pending builds, prefixes without a
+    modulefile and store objects no installation links to. With keep_under
+    the least recently used archives and artifacts are removed until the
+    caches fit into it. Paths locked by a running build are left alone.
+    '''
+    print ('Collecting garbage in %s' % (basepath))
+    db = installed_db(basepath)
+    with db.lock:
+        db.load()
+    graph = BuildGraph(True)
+    for arch in architectures:
+        for module in packages:
+            for name in packages[module]:
+                packages[module][name].expand(graph, basepath, arch, module)
+
+    source = os.path.join(package_path, 'source')
+    source_dir = lambda node: os.path.join(source, node.package.name(), node.version[0])
+    build_dir = lambda node: node.package.build_dir(source_dir(node), node.arch,
+        node.version[0], node.rext_deps, False)
+    versions = {}
+    for node in graph.order:
+        versions.setdefault((node.package.name(), node.version[0]), []).append(node)
+
+    # Everything to remove as (paths, reason, lock file, prefix), paths
+    # sharing a lock are removed together while holding it
+    garbage = []
+    pending = [build_dir(node) + os.sep for node in graph.order if not node.prefix in db]
+    for node in graph.order:
+        record = db.get(node.prefix)
+        # The build trees of other dependencies are nested in the one of Core
+        if record and os.path.isdir(build_dir(node)) and not [path for path in pending
+                if path.startswith(build_dir(node) + os.sep)]:
+            garbage.append(([build_dir(node)], 'build tree of %s' % (node),
+                node.prefix + '.lock', None))
+        if os.path.isdir(node.prefix) and (not record or
+                not os.path.lexists(record['modulefile'])):
+            garbage.append(([node.prefix], 'prefix without modulefile',
+                node.prefix + '.lock', node.prefix))
+
+    for (name, version) in sorted(versions):
+        path = os.path.join(source, name, version)
+        if not os.path.isdir(path) or [node for node in versions[(name, version)]
+                if not node.prefix in db]:
+            continue
+        for marker in sorted(os.listdir(path)):
+            if not marker.startswith('.') or not marker.endswith('.extracted'):
+                continue
+            src_dir = open(os.path.join(path, marker)).read().strip()
+            garbage.append(([src_dir, os.path.join(path, marker)],
+                'extracted sources of %s/%s' % (name, version),
+                os.path.join(path, marker[:-len('.extracted')] + '.lock'), None))
+
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            path = os.path.join(source, name)
+            if not os.path.isdir(path) or os.path.realpath(path) == os.path.realpath(download_cache):
+                continue
+            for version in sorted(os.listdir(path)):
+                if not (name, version) in versions:
+                    garbage.append(([os.path.join(path, version)],
+                        'sources of a version without recipe', None, None))
+
+    # Objects only the store links to. Objects of a store used with reflinks
+    # are kept, installations share their content without linking to them.
+    store = state_path(basepath, 'store')
+    if os.path.isdir(store) and not os.path.exists(os.path.join(store, 'reflink')):
+        for bucket in sorted(os.listdir(store)):
+            if not os.path.isdir(os.path.join(store, bucket)):
+                continue
+            for name in sorted(os.listdir(os.path.join(store, bucket))):
+                path = os.path.join(store, bucket, name)
+                if os.lstat(path).st_nlink == 1:
+                    garbage.append(([path], 'unused store object', None, None))
+
+    records = db.find()
+    paths = [record['prefix'] for record in records] + [path
+        for (paths, reason, lock_file, prefix) in garbage for path in paths]
+    sizes = dict(zip(paths, run_parallel(lambda path:
+        disk_usage(path) if os.path.isdir(path) else
+        os.lstat(path).st_blocks * 512 if os.path.lexists(path) else 0, paths, jobs)))
+
+    print ('Disk usage of installed packages:')
+    rows = []
+    for node in graph.order:
+        record = db.get(node.prefix)
+        if record:
+            build_size = sizes.get(build_dir(node), 0)
+            rows.append((sizes[node.prefix] + build_size, record, build_size))
+    for (size, record, build_size) in sorted(rows, key=lambda row: -row[0]):
+        print ('    %10s  %s/%s (%s, %s)%s' % (format_size(size), record['package'],
+            record['version'], record['arch'], format_deps(record['deps']),
+            ', build tree %s' % (format_size(build_size)) if build_size else ''))
+    for (title, path) in [('Sources', source), ('Downloads', download_cache),
+            ('Artifacts', artifacts), ('Store', store), ('Logs', state_path(basepath, 'logs'))]:
+        if path and os.path.isdir(path):
+            print ('    %10s  %s (%s)' % (format_size(disk_usage(path)), title, path))
+
+    if keep_under is not None:
+        entries = cache_entries(artifacts)
+        cached = sum(size for (used, size, paths) in entries)
+        for (used, size, paths) in entries:
+            if cached <= keep_under:
+                break
+            garbage.append((paths, 'unused since %s' % (time.strftime('%Y-%m-%d',
+                time.localtime(used))), None, None))
+            for path in paths:
+                sizes[path] = size if path == paths[0] else 0
+            cached -= size
+
+    tasks = {}
+    for item in garbage:
+        tasks.setdefault(item[2] or id(item), []).append(item)
+
+    def remove(item):
+        (paths, reason, lock_file, prefix) = item
+        if prefix:
+            with db.lock:
+                db.load()
+            record = db.get(prefix)
+            if record and os.path.lexists(record['modulefile']):
+                return 0
+            db.remove([prefix])
+            if os.path.exists(prefix + '.stamp'):
+                os.remove(prefix + '.stamp')
+        freed = 0
+        for path in paths:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+            else:
+                continue
+            freed += sizes[path]
+        print ('Removed %s (%s, %s)' % (paths[0], reason, format_size(freed)))
+        return freed
+
+    if dry_run:
+        for (paths, reason, lock_file, prefix) in garbage:
+            print ('Would remove %s (%s, %s)' % (paths[0], reason,
+                format_size(sum(sizes[path] for path in paths))))
+        print ('Would free %s' % (format_size(sum(sizes[path]
+            for item in garbage for path in item[0]))))
+        return
+
+    def collect(items):
+        lock_file = items[0][2]
+        try:
+            if not lock_file:
+                return sum(remove(item) for item in items)
+            with FileLock(lock_file, False):
+                return sum(remove(item) for item in items)
+        except IOError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            print ('Skipping %s, it is in use' % (', '.join(item[0][0] for item in items)))
+            return 0
+
+    freed = run_parallel(collect, list(tasks.values()), jobs)
+    print ('Freed %s' % (format_size(sum(size or 0 for size in freed))))
 
 def list_available():
     for module in packages:
         for package in packages[module]:
             print (packages[module][package])
 
-def install(basepath, targets, arch):
-    print ('Installing \'%s\' to %s' % (targets, basepath))
-
+def apply_environment(env, changes):
+    for (change, name, value) in changes:
+        if change == 'setenv':
+            env[name] = value
+        elif change == 'prepend_path' or (change == 'prepend_dir' and os.path.isdir(value)):
+            paths = [path for path in env.get(name, '').split(':') if path and path != value]
+            env[name] = ':'.join([value] + paths)
+
+def clean_environment(basepath, env):
+    '''
+    Returns the environment of a login shell after module purge. It's only
+    computed once and handed on to nested invocations, builds start from it
+    instead of running the profile scripts and Lmod every time. It holds the
+    credentials of the user, so it goes to a file only the user can read,
+    which is removed when the invocation computing it exits.
+    '''
+    cached = env.get('BUILDIT_CLEAN_ENV')
+    if cached and os.path.exists(cached) and os.stat(cached).st_uid == os.getuid():
+        clean = json.load(open(cached))
+        clean['BUILDIT_CLEAN_ENV'] = cached
+        return clean
+
+    marker = '==> buildit environment\n'
+    shell = subprocess.Popen(['/bin/bash', '-l', '-c',
+        'module purge > /dev/null 2>&1; echo "%s"; env -0' % (marker.strip())],
+        stdout=subprocess.PIPE, env=env)
+    output = shell.communicate()[0]
+    if shell.returncode != 0 or not marker in output:
+        print('Could not determine the environment of a login shell, using the current one')
+        return dict(env)
+    output = output[output.index(marker) + len(marker):]
+    clean = dict(line.split('=', 1) for line in output.split('\0') if '=' in line)
+    for name in ['SHLVL', '_', 'PWD', 'OLDPWD']:
+        clean.pop(name, None)
+
+    # Written to the shared basepath by earlier versions
+    shared = state_path(basepath, 'clean-environment.json')
+    if os.path.exists(shared):
+        try:
+            os.remove(shared)
+        except OSError:
+            pass
+
+    (fd, file_name) = tempfile.mkstemp(prefix='buildit-environment-', suffix='.json')
+    atexit.register(lambda: os.path.exists(file_name) and os.remove(file_name))
+    f = os.fdopen(fd, 'w')
+    f.write(json.dumps(clean))
+    f.close()
+    clean['BUILDIT_CLEAN_ENV'] = file_name
+    return clean
+
+def build_environment(basepath, lmod = False, compiler_cache = 'auto',
+        dedup = 'none', modulefile_style = 'resolved', scratch = None):
+    env = dict(os.environ)
+    if not lmod:
+        env = clean_environment(basepath, env)
+    env['COLUMNS'] = '80'
+    env['BUILDIT'] = 'python %s --basepath %s --download-cache %s%s%s%s%s%s' % (
+        os.path.realpath(__file__), basepath, download_cache,
+        ' --lmod' if lmod else '',
+        ' --compiler-cache %s' % (compiler_cache) if compiler_cache != 'auto' else '',
+        ' --dedup %s' % (dedup) if dedup != 'none' else '',
+        ' --modulefile-style %s' % (modulefile_style) if modulefile_style != 'resolved' else '',
+        ' --scratch %s' % (scratch) if scratch else '')
+    if os.path.exists(registry_cache):
+        env['BUILDIT_REGISTRY'] = registry_cache
+    return env
+
+def build_graph(basepath, targets, arch, rebuild_stale = False):
     archs = architectures
     if arch != 'all':
         if not arch in architectures:
@@ -752,11 +3148,318 @@ def install(basepath, targets, arch):
             versions = [version]
         install_packages = {module: {package.name(): package}}
 
+    graph = BuildGraph(rebuild_stale)
     for arch in archs:
         for module in install_packages:
             for name in install_packages[module]:
                 package = install_packages[module][name]
-                package.install(basepath, arch, module, versions)
+                package.expand(graph, basepath, arch, module, versions)
+
+    if rebuild_stale:
+        graph.mark_stale()
+    return graph
+
+def plan(basepath, targets, arch, artifacts = None, rebuild_stale = False,
+        output_format = 'text'):
+    graph = build_graph(basepath, targets, arch, rebuild_stale)
+    if artifacts:
+        artifacts = ArtifactStore(artifacts)
+    estimates = BuildEstimates(load_history(basepath))
+
+    builds = []
+    for node in graph.topological():
+        if node.installed:
+            state = 'installed'
+        elif artifacts and artifacts.has(node.build_hash()):
+            state = 'cached'
+        elif node.stale:
+            state = 'rebuild'
+        else:
+            state = 'build'
+        estimate = None
+        if state in ['build', 'rebuild']:
+            estimate = estimates.estimate(node)
+        builds.append({
+            'id': node.prefix,
+            'package': node.package.name(),
+            'module': node.module,
+            'version': node.version[0],
+            'arch': node.arch,
+            'deps': node.dep_versions(),
+            'requires': [dep.prefix for dep in node.deps],
+            'state': state,
+            'estimate': estimate
+        })
+
+    count = lambda state: len([b for b in builds if b['state'] == state])
+    needed = [b for b in builds if b['state'] in ['build', 'rebuild']]
+    summary = {
+        'nodes': len(builds),
+        'installed': count('installed'),
+        'cached': count('cached'),
+        'build': len(needed),
+        'estimate': sum(b['estimate'] for b in needed if b['estimate'] is not None),
+        'unknown': len([b for b in needed if b['estimate'] is None])
+    }
+
+    if output_format == 'json':
+        print(json.dumps({'targets': targets, 'builds': builds,
+            'summary': summary}, sort_keys=True, indent=4, separators=(',', ': ')))
+        return
+
+    print ('Build plan for \'%s\' in %s' % (targets, basepath))
+    for b in builds:
+        deps = format_deps(b['deps'])
+        line = '  %-10s %s/%s (%s, %s)' % (b['state'], b['package'],
+            b['version'], b['arch'], deps)
+        if b['state'] in ['build', 'rebuild']:
+            line += '  ~%s' % (format_duration(b['estimate']))
+        print(line)
+    print ('%s builds needed, %s from cache, %s already installed' % (
+        summary['build'], summary['cached'], summary['installed']))
+    print ('Estimated build time: %s (serial)%s' % (
+        format_duration(summary['estimate']),
+        ', %s builds without history' % (summary['unknown']) if summary['unknown'] else ''))
+
+def critical_path(builds):
+    '''
+    Returns the chain of builds with the longest total build time, following
+    the prefixes each build requires.
+    '''
+    longest = {}
+    def path(prefix):
+        if not prefix in longest:
+            longest[prefix] = (0, [])
+            deps = [path(dep) for dep in builds[prefix]['requires'] if dep in builds]
+            (time_before, chain) = max(deps) if deps else (0, [])
+            longest[prefix] = (time_before + builds[prefix]['build_time'],
+                chain + [prefix])
+        return longest[prefix]
+    if not builds:
+        return (0, [])
+    return max(path(prefix) for prefix in builds)
+
+def report(basepath, top = 10, output_format = 'text'):
+    '''
+    Summarizes the recorded builds: the slowest packages and recipe steps, the
+    wall and CPU time of every build and the critical path through the
+    dependencies, which bounds what more concurrent builds can gain.
+    '''
+    builds = {}
+    for entry in load_history(basepath):
+        if entry.get('origin') == 'build' and entry.get('build_time') is not None:
+            builds[entry['prefix']] = entry
+
+    steps = {}
+    events = state_path(basepath, 'events.jsonl')
+    if os.path.exists(events):
+        for line in open(events):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if 'step' in event and event['prefix'] in builds:
+                steps[(event['prefix'], event['step'])] = event
+
+    work = sum(b['build_time'] for b in builds.values())
+    (path_time, path) = critical_path(builds)
+    slowest = sorted(builds.values(), key=lambda b: -b['build_time'])[:top]
+    slowest_steps = sorted(steps.values(), key=lambda s: -s['duration'])[:top]
+    phases = {}
+    for step in steps.values():
+        phases[step['phase']] = phases.get(step['phase'], 0) + step['duration']
+    cpu_builds = [b for b in builds.values() if b.get('cpu_time') is not None]
+    cpu_time = sum(b['cpu_time'] for b in cpu_builds)
+    cpu_wall = sum(b['build_time'] for b in cpu_builds)
+    cache = {'hits': 0, 'misses': 0}
+    for b in builds.values():
+        for key in cache:
+            cache[key] += (b.get('compiler_cache') or {}).get(key, 0)
+
+    summary = {
+        'builds': len(builds),
+        'work': work,
+        'critical_path': path_time,
+        'max_speedup': work / path_time if path_time else None,
+        'cpu_time': cpu_time,
+        'average_cores': cpu_time / cpu_wall if cpu_wall else None,
+        'phases': phases,
+        'compiler_cache': cache
+    }
+
+    if output_format == 'json':
+        print(json.dumps({'summary': summary, 'slowest': slowest,
+            'slowest_steps': slowest_steps, 'critical_path': path},
+            sort_keys=True, indent=4, separators=(',', ': ')))
+        return
+
+    def name(b):
+        return '%s/%s (%s, %s)' % (b['package'], b['version'], b['arch'],
+            format_deps(b['deps']))
+
+    print('Build report for %s, %s recorded builds' % (basepath, len(builds)))
+    print('Slowest builds (wall time, CPU time, cores used/jobs):')
+    for b in slowest:
+        cores = '%5.1f' % (b['cpu_time'] / b['build_time']) \
+            if b.get('cpu_time') is not None and b['build_time'] else '    ?'
+        print('  %s %s %s/%s  %s' % (format_duration(b['build_time']),
+            format_duration(b.get('cpu_time')), cores, b.get('jobs') or '?', name(b)))
+    if slowest_steps:
+        print('Slowest steps:')
+        for s in slowest_steps:
+            print('  %s %-9s %s/%s: %s' % (format_duration(s['duration']),
+                s['phase'], s['name'], s['version'], s['command']))
+        print('Time per phase: %s' % (', '.join('%s %s' % (phase,
+            format_duration(phases[phase])) for phase in sorted(phases))))
+    print('Critical path (%s):' % (format_duration(path_time)))
+    for prefix in path:
+        print('  %s %s' % (format_duration(builds[prefix]['build_time']),
+            name(builds[prefix])))
+    print('Serial build time %s, at most %.1fx faster with unlimited concurrent builds' % (
+        format_duration(work), summary['max_speedup'] or 1))
+    for jobs in [2, 4, 8, 16]:
+        print('  --jobs %-2d at least %s' % (jobs,
+            format_duration(max(work / jobs, path_time))))
+    if summary['average_cores'] is not None:
+        print('The builds kept %.1f cores busy on average' % (
+            summary['average_cores']))
+    if cache['hits'] + cache['misses']:
+        print('Compiler cache: %s hits, %s misses (%.0f%% hit rate)' % (
+            cache['hits'], cache['misses'],
+            100. * cache['hits'] / (cache['hits'] + cache['misses'])))
+
+def install(basepath, targets, arch, jobs = 1, cores = None, fetch_jobs = 4,
+        fetch_only = False, artifacts = None, rebuild_stale = False,
+        keep_going = False, log_tail = 20, lmod = False,
+        compiler_cache = 'auto', dedup = 'none', modulefile_style = 'resolved',
+        scratch = None):
+    print ('Installing \'%s\' to %s' % (targets, basepath))
+
+    graph = build_graph(basepath, targets, arch, rebuild_stale)
+    for node in graph.pending():
+        if node.stale:
+            print('Rebuilding stale %s' % (node))
+
+    if artifacts:
+        artifacts = ArtifactStore(artifacts)
+
+    fetcher = Fetcher(download_cache, fetch_jobs)
+    fetcher.fetch(graph.sources(artifacts))
+    if fetch_only:
+        failed = fetcher.wait()
+        if failed:
+            for url in failed:
+                print('Failed to download %s' % (url))
+            exit(1)
+        return
+
+    jobserver = JobServer(cores, jobs)
+    env = build_environment(basepath, lmod, compiler_cache, dedup,
+        modulefile_style, scratch)
+    env.update(jobserver.environment())
+    context = BuildContext(basepath, env, jobserver, fetcher, artifacts,
+        log_tail, lmod, CompilerCache(basepath, compiler_cache),
+        ContentStore(basepath, dedup) if dedup != 'none' else None,
+        modulefile_style, scratch)
+    scheduler = Scheduler(graph, jobs, keep_going)
+    (done, failed, skipped) = scheduler.run(
+        lambda node: node.package.build(context, node))
+    # A nested invocation leaves the spider cache to its parent
+    refresh_module_cache(basepath, node_subtrees(basepath, done),
+        not jobserver.inherited)
+
+    if failed:
+        pending = len(graph.pending())
+        print('Built %s of %s packages, %s failed, %s skipped' % (len(done),
+            pending + len(done), len(failed), len(skipped)))
+        for node in failed:
+            print('Failed to build %s' % (node))
+        for (node, failed_node) in skipped:
+            print('Skipped %s, it depends on %s' % (node, failed_node))
+        if not keep_going and pending > len(failed) + len(skipped):
+            print('Not attempted %s more, use --keep-going to build them' % (
+                pending - len(failed) - len(skipped)))
+        exit(1)
+
+def worker(basepath, targets, arch, queue = 'default', jobs = 1, cores = None,
+        artifacts = None, log_tail = 20, lmod = False, compiler_cache = 'auto',
+        dedup = 'none', modulefile_style = 'resolved', scratch = None):
+    '''
+    Builds the targets together with other workers sharing the same queue.
+    Every worker expands the build graph itself and only takes part in the
+    nodes it knows about, so workers may be given different targets.
+    '''
+    print ('Working on \'%s\' in %s (queue %s)' % (targets, basepath, queue))
+
+    graph = build_graph(basepath, targets, arch)
+    work_queue = WorkQueue(basepath, queue)
+    work_queue.submit(graph)
+
+    if artifacts:
+        artifacts = ArtifactStore(artifacts)
+    jobserver = JobServer(cores, jobs)
+    env = build_environment(basepath, lmod, compiler_cache, dedup,
+        modulefile_style, scratch)
+    env.update(jobserver.environment())
+    context = BuildContext(basepath, env, jobserver, Fetcher(download_cache),
+        artifacts, log_tail, lmod, CompilerCache(basepath, compiler_cache),
+        ContentStore(basepath, dedup) if dedup != 'none' else None,
+        modulefile_style, scratch)
+
+    # The heartbeat shows other workers this process is still alive
+    work_queue.heartbeat()
+    stopped = threading.Event()
+    def heartbeat():
+        while not stopped.wait(queue_heartbeat_interval):
+            work_queue.heartbeat()
+    heartbeat_thread = threading.Thread(target=heartbeat)
+    heartbeat_thread.daemon = True
+    heartbeat_thread.start()
+
+    built = []
+    def work(index):
+        name = '%s:%d:%d' % (socket.gethostname(), os.getpid(), index)
+        while True:
+            prefix = work_queue.claim(name, graph.nodes)
+            if prefix is None:
+                return
+            if prefix == WorkQueue.WAIT:
+                time.sleep(queue_poll_interval)
+                continue
+
+            node = graph.nodes[prefix]
+            try:
+                ok = node.package.build(context, node)
+            except Exception:
+                traceback.print_exc()
+                ok = False
+            work_queue.finish(prefix, ok)
+            if ok:
+                built.append(node)
+
+    threads = []
+    for index in range(max(1, jobs)):
+        thread = threading.Thread(target=work, args=(index,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+    stopped.set()
+    work_queue.stop()
+
+    refresh_module_cache(basepath, node_subtrees(basepath, built),
+        not jobserver.inherited)
+    (state, counts) = work_queue.summary()
+    print ('Queue %s: %s' % (queue, ', '.join('%s %s' % (counts[s], s)
+        for s in sorted(counts))))
+    failed = [node['name'] for node in state['nodes'].values()
+        if node['state'] in ['failed', 'skipped']]
+    if failed:
+        for name in sorted(failed):
+            print('Failed to build %s' % (name))
+        exit(1)
 
 def uninstall(basepath, targets, arch):
     print ('Uninstalling \'%s\' to %s' % (targets, basepath))
@@ -780,13 +3483,21 @@ def uninstall(basepath, targets, arch):
             versions = [version]
         uninstall_packages = {module: {package.name(): package}}
 
+    db = installed_db(basepath)
+    installed = dict(db.records)
     for arch in archs:
         for module in uninstall_packages:
             for name in uninstall_packages[module]:
                 package = uninstall_packages[module][name]
                 package.uninstall(basepath, arch, module, versions)
+    refresh_module_cache(basepath, set((record['arch'], module_subtree(basepath,
+        record['arch'], record['modulefile'])) for (prefix, record) in installed.items()
+        if not prefix in db and record.get('modulefile')))
 
 def main():
+    global download_cache
+    global lmod_cache
+
     parser = argparse.ArgumentParser(description='build.py')
     parser.add_argument('--basepath', default='/opt/apps',
         help='Base path for the packages to be installed')
@@ -800,40 +3511,175 @@ def main():
         help='Uninstalls the software package (default=all)')
     parser.add_argument('--install', action='store_const', const=True, default=False,
         help='Installs the software package')
+    parser.add_argument('--plan', action='store_const', const=True, default=False,
+        help='Shows the builds needed to install the targets')
+    parser.add_argument('--dry-run', action='store_const', const=True, default=False,
+        help='Shows the plan for --install instead of building, or what --gc would remove')
+    parser.add_argument('--format', choices=['text', 'json'], default='text',
+        help='The output format of --plan and --report (default=text)')
+    parser.add_argument('--report', action='store_const', const=True, default=False,
+        help='Shows the slowest builds and the critical path of past builds')
+    parser.add_argument('--top', type=int, default=10,
+        help='The number of builds and steps shown by --report (default=10)')
+    parser.add_argument('--worker', action='store_const', const=True, default=False,
+        help='Builds the targets together with other workers on a shared queue')
+    parser.add_argument('--queue', default='default',
+        help='The name of the shared build queue for --worker (default=default)')
+    parser.add_argument('--reindex', action='store_const', const=True, default=False,
+        help='Rebuilds the list of installed packages from the file system')
+    parser.add_argument('--fetch-only', action='store_const', const=True, default=False,
+        help='Downloads the sources needed to install the targets without building')
     parser.add_argument('--targets', default='all',
         help='The targets for (un)installation (default=all)')
+    parser.add_argument('--jobs', type=int, default=1,
+        help='The number of package builds to run concurrently (default=1)')
+    parser.add_argument('--cores', type=int, default=None,
+        help='The number of cores shared between all builds (default=all)')
+    parser.add_argument('--fetch-jobs', type=int, default=4,
+        help='The number of concurrent source downloads (default=4)')
+    parser.add_argument('--keep-going', action='store_const', const=True, default=False,
+        help='Keeps building what does not depend on a failed package')
+    parser.add_argument('--compiler-cache', choices=['auto', 'ccache', 'sccache', 'none'],
+        default='auto', help='The compiler cache to build with (default=auto)')
+    parser.add_argument('--dedup', choices=['none', 'hardlink', 'reflink'], default='none',
+        help='Shares identical files between installations (default=none)')
+    parser.add_argument('--gc', action='store_const', const=True, default=False,
+        help='Reports the disk usage and removes build trees, sources and prefixes which are not needed anymore')
+    parser.add_argument('--keep-under', type=parse_size, default=None,
+        help='With --gc, removes the least recently used archives and artifacts until they fit into this size, like 200G')
+    parser.add_argument('--regenerate-modulefiles', action='store_const', const=True, default=False,
+        help='Rewrites the modulefiles of the installed targets in --jobs threads (default=8)')
+    parser.add_argument('--lmod-cache', default=None,
+        help='Directory of the Lmod spider caches (default=<basepath>/.buildit/lmod-cache)')
+    parser.add_argument('--refresh-module-cache', action='store_const', const=True, default=False,
+        help='Rewrites the module index and the Lmod spider cache')
+    parser.add_argument('--deduplicate', action='store_const', const=True, default=False,
+        help='Shares identical files between all installed packages')
+    parser.add_argument('--install-shared', nargs=2, metavar=('SOURCE', 'TARGET'),
+        help='Copies SOURCE to TARGET, with --dedup sharing identical files with other installations')
+    parser.add_argument('--modulefile-style', choices=['resolved', 'generic'], default='resolved',
+        help='Write a modulefile per installed version, or link versions to a generic one (default=resolved)')
+    parser.add_argument('--scratch', default=None,
+        help='Extracts and builds packages in a directory on a fast local file system, like /dev/shm')
+    parser.add_argument('--lmod', action='store_const', const=True, default=False,
+        help='Loads the dependencies of a build with Lmod in a login shell')
+    parser.add_argument('--log-tail', type=int, default=20,
+        help='The number of lines of the build log shown on failure (default=20)')
+    parser.add_argument('--rebuild-stale', action='store_const', const=True, default=False,
+        help='Rebuilds installed packages whose recipe or dependencies changed')
+    parser.add_argument('--artifacts', default=None,
+        help='Directory of packed builds to reuse (default=<basepath>/.buildit/artifacts)')
+    parser.add_argument('--no-artifacts', action='store_const', const=True, default=False,
+        help='Neither reuse nor store packed builds')
+
+    parser.add_argument('--download-cache', default=download_cache,
+        help='Directory of the shared download cache (default=%s)' % (download_cache))
 
     args = parser.parse_args()
 
-    command_list = [args.list, args.available, args.install, args.uninstall]
+    command_list = [args.list, args.available, args.install, args.uninstall,
+        args.fetch_only, args.reindex, args.plan, args.worker, args.report,
+        args.deduplicate, args.install_shared, args.refresh_module_cache,
+        args.regenerate_modulefiles, args.gc]
 
     # Check if we have any of the commands
     if (reduce(lambda opt1, opt2: opt1 or opt2, command_list, False)):
         # Check if we don't have two commands at the same time:
         if (reduce(lambda opt1, opt2: not opt2 if (opt1) else opt2, command_list, True)):
-            print ('Please provide only of --list, --available, --uninstall, --install')
+            print ('Please provide only of --list, --available, --uninstall, --install, --fetch-only, --reindex, --plan, --worker, --report, --deduplicate, --install-shared, --refresh-module-cache, --regenerate-modulefiles, --gc')
             exit(1)
     else:
-        print ('Please provide one of --list, --available, --uninstall, --install')
+        print ('Please provide one of --list, --available, --uninstall, --install, --fetch-only, --reindex, --plan, --worker, --report, --deduplicate, --install-shared, --refresh-module-cache, --regenerate-modulefiles, --gc')
         exit(1)
 
-    packages = load_packages()
+    download_cache = os.path.abspath(args.download_cache)
+    if args.lmod_cache:
+        lmod_cache = os.path.abspath(args.lmod_cache)
+
+    # Commands for a single target only need to load what it depends on
+    targeted = (args.install or args.plan or args.fetch_only or args.worker or
+        args.uninstall or args.regenerate_modulefiles)
+    load_packages(args.targets if targeted else 'all')
 
     basepath = args.basepath
 
     if not os.path.exists(basepath):
         os.makedirs(basepath)
 
+    if args.scratch:
+        args.scratch = os.path.abspath(args.scratch)
+        makedirs(args.scratch)
+
+    if (args.install_shared):
+        (source, target) = args.install_shared
+        # Installations only share files if asked to, changing a hardlinked
+        # file changes it in all of them
+        store = ContentStore(basepath, args.dedup) if args.dedup != 'none' else None
+        saved = install_tree(source, target, store)
+        print ('Installed %s to %s%s' % (source, target,
+            ', %s shared' % (format_size(saved)) if store else ''))
+        return
+
     if (args.list):
         list_installed(basepath)
         return
 
+    if (args.refresh_module_cache):
+        refresh_module_cache(basepath)
+        return
+
+    if (args.regenerate_modulefiles):
+        regenerate_modulefiles(basepath, args.targets, args.arch,
+            args.jobs if args.jobs > 1 else 8, args.modulefile_style)
+        return
+
+    if (args.deduplicate):
+        deduplicate(basepath, args.dedup if args.dedup != 'none' else 'hardlink')
+        return
+
+    if (args.reindex):
+        reindex(basepath)
+        return
+
     if (args.available):
         list_available()
         return
 
+    artifacts = args.artifacts or state_path(basepath, 'artifacts')
+    if args.no_artifacts:
+        artifacts = None
+
+    if (args.report):
+        report(basepath, args.top, args.format)
+        return
+
+    if (args.gc):
+        gc(basepath, artifacts, args.keep_under, args.dry_run,
+            args.jobs if args.jobs > 1 else 8)
+        return
+
+    if (args.plan or (args.install and args.dry_run)):
+        plan(basepath, args.targets, args.arch, artifacts, args.rebuild_stale,
+            args.format)
+        return
+
     if (args.install):
-        install(basepath, args.targets, args.arch)
+        install(basepath, args.targets, args.arch, args.jobs, args.cores,
+            args.fetch_jobs, artifacts=artifacts, rebuild_stale=args.rebuild_stale,
+            keep_going=args.keep_going, log_tail=args.log_tail, lmod=args.lmod,
+            compiler_cache=args.compiler_cache, dedup=args.dedup,
+            modulefile_style=args.modulefile_style, scratch=args.scratch)
+        return
+
+    if (args.worker):
+        worker(basepath, args.targets, args.arch, args.queue, args.jobs,
+            args.cores, artifacts, args.log_tail, args.lmod, args.compiler_cache,
+            args.dedup, args.modulefile_style, args.scratch)
+        return
+
+    if (args.fetch_only):
+        install(basepath, args.targets, args.arch, fetch_jobs=args.fetch_jobs,
+            fetch_only=True, artifacts=artifacts)
         return
 
     if (args.uninstall):
@@ -0,0 +1,105 @@
+'''
+Tests of the download cache against a local HTTP server supporting Range
+requests. Run with python -m unittest discover tests
+'''
+import BaseHTTPServer
+import hashlib
+import imp
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+build = imp.load_source('build', os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', 'build.py'))
+
+content = ''.join(chr(i % 251) for i in range(300 * 1024))
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        Handler.requests.append((self.path, self.headers.getheader('Range')))
+        body = content
+        if self.path.startswith('/broken'):
+            body = 'x' + content[1:]
+        offset = 0
+        if self.headers.getheader('Range'):
+            offset = int(self.headers.getheader('Range')[len('bytes='):].split('-')[0])
+            if offset >= len(body):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                offset, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body) - offset))
+        self.end_headers()
+        self.wfile.write(body[offset:])
+
+    def log_message(self, *args):
+        pass
+
+class DownloadTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.base_url = 'http://127.0.0.1:%d' % (cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.cache = tempfile.mkdtemp()
+        Handler.requests = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cache)
+
+    def partial(self, url):
+        return os.path.join(self.cache, 'partial', hashlib.sha256(url).hexdigest())
+
+    def test_download_is_verified_and_cached(self):
+        url = self.base_url + '/pkg-1.0.tar.gz'
+        source = {'url': url, 'sha256': hashlib.sha256(content).hexdigest()}
+        file_name = build.download_source(source, self.cache, False)
+        self.assertEqual(os.path.basename(file_name), 'pkg-1.0.tar.gz')
+        self.assertEqual(open(file_name, 'rb').read(), content)
+        self.assertEqual(build.download_source(source, self.cache, False), file_name)
+        self.assertEqual(build.download_source(url, self.cache, False), file_name)
+        self.assertEqual(len(Handler.requests), 1)
+
+    def test_partial_download_is_resumed(self):
+        url = self.base_url + '/resume-1.0.tar.gz'
+        build.makedirs(os.path.dirname(self.partial(url)))
+        open(self.partial(url), 'wb').write(content[:100000])
+        file_name = build.download_source({'url': url,
+            'sha256': hashlib.sha256(content).hexdigest()}, self.cache, False)
+        self.assertEqual(Handler.requests, [('/resume-1.0.tar.gz', 'bytes=100000-')])
+        self.assertEqual(open(file_name, 'rb').read(), content)
+        self.assertFalse(os.path.exists(self.partial(url)))
+
+    def test_complete_partial_download_restarts(self):
+        url = self.base_url + '/complete-1.0.tar.gz'
+        build.makedirs(os.path.dirname(self.partial(url)))
+        open(self.partial(url), 'wb').write(content)
+        file_name = build.download_source(url, self.cache, False)
+        self.assertEqual(open(file_name, 'rb').read(), content)
+
+    def test_checksum_mismatch_is_rejected(self):
+        url = self.base_url + '/broken-1.0.tar.gz'
+        source = {'url': url, 'sha256': hashlib.sha256(content).hexdigest()}
+        self.assertRaises(Exception, build.download_source, source, self.cache, False)
+        self.assertFalse(os.path.exists(self.partial(url)))
+        self.assertIsNone(build.cached_source(source, self.cache))
+
+if __name__ == '__main__':
+    unittest.main()
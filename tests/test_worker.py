@@ -0,0 +1,117 @@
+'''
+Tests of the shared build queue with several worker processes working on
+the same basepath. Run with python -m unittest discover tests
+'''
+import imp
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'build.py')
+build = imp.load_source('build', script)
+
+recipes = {
+    'Core/a.json': {'name': 'a', 'versions': [['1.0']]},
+    'Misc/b.json': {'name': 'b', 'versions': [['1.0']], 'dependencies': ['a/1.0']},
+    'Misc/c.json': {'name': 'c', 'versions': [['1.0'], ['2.0']], 'dependencies': ['a/1.0']},
+    'Misc/d.json': {'name': 'd', 'versions': [['1.0']], 'dependencies': ['b/1.0', 'c/2.0']}
+}
+
+class WorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.basepath = os.path.join(self.path, 'apps')
+        shutil.copy(script, self.path)
+        for (file_name, recipe) in recipes.items():
+            recipe = dict(recipe, architectures='all',
+                build=['sleep 0.5', 'mkdir -p $PACKAGE_PREFIX'])
+            build.makedirs(os.path.join(self.path, 'packages', os.path.dirname(file_name)))
+            json.dump(recipe, open(os.path.join(self.path, 'packages', file_name), 'w'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def run_workers(self, count, targets = 'all'):
+        env = dict(os.environ, HOME=self.path)
+        env.pop('BUILDIT_JOBSERVER', None)
+        workers = [subprocess.Popen([sys.executable, os.path.join(self.path, 'build.py'),
+            '--basepath', self.basepath, '--worker', '--queue', 'test', '--targets',
+            targets, '--jobs', '2', '--no-artifacts'], env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT) for i in range(count)]
+        outputs = [worker.communicate()[0] for worker in workers]
+        for (worker, output) in zip(workers, outputs):
+            self.assertEqual(worker.returncode, 0, output)
+        return outputs
+
+    def builds(self):
+        history = os.path.join(self.basepath, '.buildit', 'history.jsonl')
+        entries = [json.loads(line) for line in open(history) if line.strip()]
+        return sorted(os.path.relpath(entry['prefix'], self.basepath)
+            for entry in entries if entry.get('origin') == 'build')
+
+    def test_workers_build_every_node_once(self):
+        self.run_workers(3)
+        self.assertEqual(self.builds(), ['x86_64/a/1.0', 'x86_64/b/1.0',
+            'x86_64/c/1.0', 'x86_64/c/2.0', 'x86_64/d/1.0'])
+        state = json.load(open(os.path.join(self.basepath, '.buildit', 'queue',
+            'test', 'state.json')))
+        self.assertEqual(set(node['state'] for node in state['nodes'].values()),
+            set(['done']))
+        self.assertEqual(os.listdir(os.path.join(self.basepath, '.buildit',
+            'queue', 'test', 'workers')), [])
+
+    def test_workers_with_different_targets(self):
+        self.run_workers(1, 'c')
+        self.run_workers(2, 'd')
+        self.assertEqual(self.builds(), ['x86_64/a/1.0', 'x86_64/b/1.0',
+            'x86_64/c/1.0', 'x86_64/c/2.0', 'x86_64/d/1.0'])
+
+class ClaimTest(unittest.TestCase):
+    def setUp(self):
+        self.basepath = tempfile.mkdtemp()
+        self.queue = build.WorkQueue(self.basepath, 'test')
+        build.makedirs(self.queue.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.basepath)
+
+    def claimed(self, host, pid):
+        self.queue.save({'created': 0, 'order': ['/p/a'], 'nodes': {'/p/a': {
+            'name': 'a', 'requires': [], 'state': 'claimed',
+            'worker': '%s:%d:0' % (host, pid), 'host': host, 'pid': pid}}})
+
+    def heartbeat(self, host, pid, age = 0):
+        file_name = self.queue.worker_file(host, pid)
+        build.makedirs(os.path.dirname(file_name))
+        open(file_name, 'w').close()
+        self.queue.heartbeat()
+        last = os.path.getmtime(self.queue.heartbeat_file) - age
+        os.utime(file_name, (last, last))
+
+    def test_claim_of_responding_worker_is_kept(self):
+        self.claimed('elsewhere', 1)
+        self.heartbeat('elsewhere', 1, 10)
+        self.assertEqual(self.queue.claim('test', ['/p/a']), build.WorkQueue.WAIT)
+
+    def test_claim_of_silent_worker_is_requeued(self):
+        self.claimed('elsewhere', 1)
+        self.heartbeat('elsewhere', 1, build.queue_worker_timeout + 10)
+        self.assertEqual(self.queue.claim('test', ['/p/a']), '/p/a')
+
+    def test_claim_of_worker_without_heartbeat_is_requeued(self):
+        self.claimed('elsewhere', 1)
+        self.assertEqual(self.queue.claim('test', ['/p/a']), '/p/a')
+
+    def test_claim_of_dead_local_worker_is_requeued(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        self.claimed(build.socket.gethostname(), process.pid)
+        self.heartbeat(build.socket.gethostname(), process.pid)
+        self.assertEqual(self.queue.claim('test', ['/p/a']), '/p/a')
+
+if __name__ == '__main__':
+    unittest.main()